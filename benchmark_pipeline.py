@@ -0,0 +1,247 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import resource
+import threading
+import time
+
+import cv2
+import numpy
+
+import multicam_stream_consumer
+import multistream_cam_producer
+from stage_profiler import install_profiler_signal_handler
+from student_count import BATCHING_STACKED, batched_detections
+
+BENCHMARK_DURATION = 20
+# Extra seconds the consumer gets to drain the buffer after the cameras stop
+BENCHMARK_DRAIN_DURATION = 5
+SYNTHETIC_FRAME_SIZE = (1920, 1080)
+
+
+class SyntheticStream:
+    """A class to represent a synthetic camera stream with the interface of cv2.VideoCapture"""
+
+    def __init__(self, fps: float, frame_size: tuple = SYNTHETIC_FRAME_SIZE, seed: int = 0):
+        """Initialize the stream with a fixed noise frame"""
+        self.fps = fps
+        self.frame_size = frame_size
+        width, height = frame_size
+        self.frame = numpy.random.default_rng(seed).integers(0, 255, (height, width, 3), dtype=numpy.uint8)
+        self.next_frame_time = time.monotonic()
+        self.opened = True
+
+    def read(self):
+        """Returns the next frame once it is due, like a live camera"""
+        if not self.opened:
+            return False, None
+        delay = self.next_frame_time - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        self.next_frame_time = max(self.next_frame_time + 1 / self.fps, time.monotonic() - 1 / self.fps)
+        return True, self.frame.copy()
+
+    def isOpened(self):
+        """Returns whether the stream is open"""
+        return self.opened
+
+    def get(self, prop_id):
+        """Returns the frame size and frame rate properties of the stream"""
+        width, height = self.frame_size
+        return {cv2.CAP_PROP_FRAME_WIDTH: width, cv2.CAP_PROP_FRAME_HEIGHT: height, cv2.CAP_PROP_FPS: self.fps}.get(
+            prop_id, 0
+        )
+
+    def release(self):
+        """Closes the stream"""
+        self.opened = False
+
+
+class FakeDetector:
+    """
+    A class to represent a detector that models the latency of a batch and records the latency of every frame. The
+    frames go through the same stacked or mosaic batching as the real detector, and every image given to the model
+    costs the per-frame latency, since the model input size is fixed.
+    """
+
+    def __init__(self, per_batch_latency: float, per_frame_latency: float, batching_mode: str = BATCHING_STACKED):
+        """Initialize the detector"""
+        self.per_batch_latency = per_batch_latency
+        self.per_frame_latency = per_frame_latency
+        self.batching_mode = batching_mode
+        self.latencies = []
+
+    def detect(self, images):
+        """Sleeps for the modelled inference time of the images and detects nothing"""
+        time.sleep(self.per_batch_latency + self.per_frame_latency * len(images))
+        return [[] for _ in images]
+
+    def __call__(self, batch_of_frames, batch_of_cam_names, batch_of_cam_ips, batch_of_capture_times=None):
+        """Runs the modelled detection on the batch"""
+        batched_detections(self.detect, batch_of_frames, self.batching_mode)
+        inference_end_time = time.monotonic()
+        if batch_of_capture_times is not None:
+            self.latencies.extend(inference_end_time - capture_time for capture_time in batch_of_capture_times)
+
+
+def _metric_total(family) -> float:
+    """Returns the sum of a metric over all its label values"""
+    return sum(value.value for _, value in family.items())
+
+
+def _resource_usage() -> dict:
+    """Returns the CPU time and peak memory of the process"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {"cpu_seconds": usage.ru_utime + usage.ru_stime, "max_rss_mb": usage.ru_maxrss / 1024}
+
+
+def _report_and_exit(role: str, stats: dict, stats_buffer):
+    """Sends the statistics of the process and leaves without waiting for the pipeline threads, which run forever"""
+    stats.update({f"{role}_{key}": value for key, value in _resource_usage().items()})
+    stats_buffer.put((role, stats))
+    stats_buffer.close()
+    stats_buffer.join_thread()
+    os._exit(0)
+
+
+def _run_producer(shared_buffer, scenario: dict, stats_buffer):
+    """Runs producer_main over synthetic cameras and reports its statistics"""
+    multistream_cam_producer.FRAME_RATE_FACTOR = scenario["frame_rate_factor"]
+    multistream_cam_producer.IP_CAMS = {
+        f"synthetic-cam-{index}": f"http://synthetic/{index}" for index in range(scenario["cameras"])
+    }
+    multistream_cam_producer.open_stream = lambda cam_ip: SyntheticStream(
+        scenario["fps"], seed=int(cam_ip.rsplit("/", 1)[1])
+    )
+
+    multistream_cam_producer.producer_main(shared_buffer)
+    time.sleep(scenario["duration"])
+    stats = {
+        "frames_read": _metric_total(multistream_cam_producer.FRAMES_READ),
+        "frames_captured": _metric_total(multistream_cam_producer.FRAMES_CAPTURED),
+    }
+    _report_and_exit("producer", stats, stats_buffer)
+
+
+def _run_consumer(shared_buffer, scenario: dict, stats_buffer):
+    """Runs consumer_main with a fake detector and reports its statistics"""
+    multicam_stream_consumer.BATCH_SIZE = scenario["batch_size"]
+    multicam_stream_consumer.LIVE_STREAM_BUFFER_SIZE = scenario["buffer_size"]
+    detector = FakeDetector(scenario["per_batch_latency"], scenario["per_frame_latency"], scenario["batching_mode"])
+    multicam_stream_consumer.batched_frame_student_count = detector
+
+    consumer_thread = threading.Thread(
+        target=multicam_stream_consumer.consumer_main, args=(shared_buffer,), daemon=True
+    )
+    consumer_thread.start()
+    time.sleep(scenario["duration"])
+    # the throughput is measured while the cameras run, the drain only settles what is left in the buffer
+    frames_processed_while_capturing = _metric_total(multicam_stream_consumer.FRAMES_PROCESSED)
+    time.sleep(BENCHMARK_DRAIN_DURATION)
+
+    latencies = sorted(detector.latencies)
+    stats = {
+        "frames_processed_while_capturing": frames_processed_while_capturing,
+        "frames_processed": _metric_total(multicam_stream_consumer.FRAMES_PROCESSED),
+        "frames_dropped": _metric_total(multicam_stream_consumer.FRAMES_DROPPED),
+        "latency_p50": latencies[len(latencies) // 2] if latencies else None,
+        "latency_p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else None,
+    }
+    _report_and_exit("consumer", stats, stats_buffer)
+
+
+def run_scenario(scenario: dict) -> dict:
+    """
+    Runs the producer and the consumer processes on one scenario
+
+    Args:
+        scenario (dict): number of cameras, camera fps, frame rate factor, batch size, buffer size, batching mode,
+            duration and latencies of the fake detector
+
+    Returns:
+        dict: the scenario together with its throughput, drop and undelivered rates, latency, CPU and memory results
+    """
+    shared_buffer = multiprocessing.Queue()
+    stats_buffer = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(target=_run_producer, args=(shared_buffer, scenario, stats_buffer)),
+        multiprocessing.Process(target=_run_consumer, args=(shared_buffer, scenario, stats_buffer)),
+    ]
+    for process in processes:
+        process.start()
+
+    stats = {}
+    for _ in processes:
+        _, process_stats = stats_buffer.get()
+        stats.update(process_stats)
+    for process in processes:
+        process.join()
+    shared_buffer.cancel_join_thread()
+
+    frames_captured = stats["frames_captured"]
+    result = dict(scenario)
+    result.update(stats)
+    result["frames_per_second"] = stats["frames_processed_while_capturing"] / scenario["duration"]
+    # frames still in the buffer after the drain, or on their way to it, were neither processed nor dropped
+    result["frames_undelivered"] = max(0, frames_captured - stats["frames_processed"] - stats["frames_dropped"])
+    result["drop_rate"] = stats["frames_dropped"] / frames_captured if frames_captured else 0.0
+    result["undelivered_rate"] = result["frames_undelivered"] / frames_captured if frames_captured else 0.0
+    return result
+
+
+def _parse_list(value: str, cast):
+    """Parses a comma separated list of values"""
+    return [cast(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the producer/consumer pipeline with synthetic cameras")
+    parser.add_argument("--cameras", default="2,8", help="comma separated numbers of cameras")
+    parser.add_argument("--fps", default="25", help="comma separated frame rates of the cameras")
+    parser.add_argument("--frame-rate-factor", default="3", help="comma separated values of FRAME_RATE_FACTOR")
+    parser.add_argument("--batch-size", default="16", help="comma separated values of BATCH_SIZE")
+    parser.add_argument("--buffer-size", default="2048", help="comma separated values of LIVE_STREAM_BUFFER_SIZE")
+    parser.add_argument("--batching-mode", default="stacked", help="comma separated batching modes, stacked or mosaic")
+    parser.add_argument("--per-batch-latency", type=float, default=0.02, help="fixed seconds per detector call")
+    parser.add_argument("--per-frame-latency", type=float, default=0.005, help="seconds per model input image")
+    parser.add_argument("--duration", type=float, default=BENCHMARK_DURATION, help="seconds per scenario")
+    parser.add_argument("--output", default="bench_output.jsonl", help="file the results are appended to")
+    args = parser.parse_args()
+    install_profiler_signal_handler()
+
+    grid = itertools.product(
+        _parse_list(args.cameras, int),
+        _parse_list(args.fps, float),
+        _parse_list(args.frame_rate_factor, int),
+        _parse_list(args.batch_size, int),
+        _parse_list(args.buffer_size, int),
+        _parse_list(args.batching_mode, str),
+    )
+    with open(args.output, "a") as output_file:
+        for cameras, fps, frame_rate_factor, batch_size, buffer_size, batching_mode in grid:
+            scenario = {
+                "cameras": cameras,
+                "fps": fps,
+                "frame_rate_factor": frame_rate_factor,
+                "batch_size": batch_size,
+                "buffer_size": buffer_size,
+                "batching_mode": batching_mode,
+                "per_batch_latency": args.per_batch_latency,
+                "per_frame_latency": args.per_frame_latency,
+                "duration": args.duration,
+            }
+            print(f"Running scenario {scenario}...")
+            result = run_scenario(scenario)
+            print(
+                f"{result['frames_per_second']:.1f} frames/sec, drop rate {result['drop_rate']:.2%}, "
+                f"undelivered {result['undelivered_rate']:.2%}, "
+                f"p50 {result['latency_p50']}, p99 {result['latency_p99']}"
+            )
+            output_file.write(json.dumps(result) + "\n")
+            output_file.flush()
+
+
+if __name__ == "__main__":
+    main()
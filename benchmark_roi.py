@@ -0,0 +1,97 @@
+import argparse
+import json
+
+import count_in_line
+from record_replay import counting_lines, load_golden, replay_count_in_line
+
+
+def replay_with_stats(recording_dir: str, lines: dict, **replay_options) -> dict:
+    """
+    Replays a recording as fast as possible through count_in_line
+
+    Args:
+        recording_dir (str): directory of the recording
+        lines (dict): names of the cameras mapped to their counting lines
+        replay_options: roi_mode and model_backend of the replay
+
+    Returns:
+        dict: names of the cameras mapped to their counts, throughput, detector input pixels and latency per frame
+    """
+    before = {
+        cam_name: (
+            count_in_line.DETECTION_INPUT_PIXELS.labels(cam_name).value,
+            count_in_line.FRAME_PROCESSING_SECONDS.labels(cam_name).sum,
+            count_in_line.FRAME_PROCESSING_SECONDS.labels(cam_name).count,
+        )
+        for cam_name in lines
+    }
+    results = replay_count_in_line(recording_dir, lines, **replay_options)
+
+    stats = {}
+    for cam_name, result in results.items():
+        pixels_before, seconds_before, frames_before = before[cam_name]
+        frame_processing_seconds = count_in_line.FRAME_PROCESSING_SECONDS.labels(cam_name)
+        frames = frame_processing_seconds.count - frames_before
+        stats[cam_name] = {
+            "counts": result["counts"],
+            "frames_per_second": result["frames_per_second"],
+            "pixels_per_frame": (count_in_line.DETECTION_INPUT_PIXELS.labels(cam_name).value - pixels_before) / frames,
+            "latency_mean": (frame_processing_seconds.sum - seconds_before) / frames,
+        }
+    return stats
+
+
+def compare_roi(recording_dir: str, lines: dict) -> dict:
+    """
+    Replays a recording as fast as possible with full frame detection and with ROI detection, and compares them
+
+    Args:
+        recording_dir (str): directory of the recording
+        lines (dict): names of the cameras mapped to their counting lines
+
+    Returns:
+        dict: names of the cameras mapped to the statistics of both modes, the pixels and latency saved per frame, and
+            whether the ROI counts match the full frame counts and the golden counts
+    """
+    golden = load_golden(recording_dir).get("count_in_line", {})
+
+    full_frame_stats = replay_with_stats(recording_dir, lines, roi_mode=False)
+    roi_stats = replay_with_stats(recording_dir, lines, roi_mode=True)
+
+    comparison = {}
+    for cam_name in lines:
+        full_frame, roi = full_frame_stats[cam_name], roi_stats[cam_name]
+        golden_counts = golden.get(cam_name, {}).get("counts")
+        comparison[cam_name] = {
+            "full_frame": full_frame,
+            "roi": roi,
+            "pixels_saved_per_frame": full_frame["pixels_per_frame"] - roi["pixels_per_frame"],
+            "pixels_saved_ratio": 1 - roi["pixels_per_frame"] / full_frame["pixels_per_frame"],
+            "latency_saved_per_frame": full_frame["latency_mean"] - roi["latency_mean"],
+            "counts_match_full_frame": roi["counts"] == full_frame["counts"],
+            "counts_match_golden": None if golden_counts is None else roi["counts"] == golden_counts,
+        }
+    return comparison
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare full frame and line-band ROI detection on a recording")
+    parser.add_argument("recording_dir")
+    parser.add_argument("--line", action="append", default=[], help="count_in_line camera as name=x1,y1,x2,y2")
+    parser.add_argument("--output", default="bench_roi_output.jsonl", help="file the results are appended to")
+    args = parser.parse_args()
+
+    comparison = compare_roi(args.recording_dir, counting_lines(load_golden(args.recording_dir), args.line))
+    with open(args.output, "a") as output_file:
+        for cam_name, result in comparison.items():
+            print(
+                f"{cam_name}: {result['pixels_saved_ratio']:.1%} fewer pixels per frame, "
+                f"{result['latency_saved_per_frame'] * 1000:.1f} ms saved per frame, "
+                f"counts {result['roi']['counts']} with ROI vs {result['full_frame']['counts']} on the full frame "
+                f"(golden match: {result['counts_match_golden']})"
+            )
+            output_file.write(json.dumps(dict(result, recording_dir=args.recording_dir, camera=cam_name)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import os
+import queue
+import threading
+import time
+from collections import deque
+
+import cv2
+
+from pipeline_metrics import counter
+
+# Recording modes of the counting scripts
+RECORD_MODE_FULL = "full"
+RECORD_MODE_EVENTS = "events"
+RECORD_MODE_OFF = "off"
+
+CLIP_PRE_ROLL = 3.0
+CLIP_POST_ROLL = 3.0
+CLIP_OUTPUT_DIR = "clips"
+CLIP_FOURCC = "mp4v"
+# Seconds of frames the encoder may fall behind by, on top of the pre-roll, before frames are dropped
+CLIP_ENCODE_BACKLOG = 2.0
+# Largest width of the clips, larger frames are downscaled before they are kept in memory
+CLIP_FRAME_WIDTH = 640
+
+CLIPS_WRITTEN = counter("clips_written_total", "Event clips written", ("camera",))
+CLIP_FRAMES_DROPPED = counter(
+    "clip_frames_dropped_total", "Clip frames dropped because the encoder fell behind", ("camera",)
+)
+
+
+def clip_frame_size(frame_size: tuple) -> tuple:
+    """
+    Returns the size of the clips of a camera, its frame size downscaled to at most CLIP_FRAME_WIDTH
+
+    Args:
+        frame_size (tuple): (width, height) of the frames of the camera
+
+    Returns:
+        tuple: (width, height) of the clips
+    """
+    width, height = frame_size
+    if width <= CLIP_FRAME_WIDTH:
+        return frame_size
+    # the encoder needs an even height
+    return CLIP_FRAME_WIDTH, int(height * CLIP_FRAME_WIDTH / width) // 2 * 2
+
+
+class ClipRecorder:
+    """
+    A class to represent an event-triggered clip recorder. It keeps the most recent frames of a camera in a ring
+    buffer and writes a clip only around the events, from the pre-roll before the first event to the post-roll after
+    the last one, so that overlapping events end up in one clip. The frames are encoded by a background thread, off the
+    inference path. Both the ring buffer and the frames waiting for the encoder are bounded in seconds of frames, so
+    the frames should be downscaled to the clip_frame_size of the camera before they are pushed.
+    """
+
+    def __init__(self, camera_id, fps: float, frame_size: tuple, pre_roll: float = CLIP_PRE_ROLL,
+                 post_roll: float = CLIP_POST_ROLL, output_dir: str = CLIP_OUTPUT_DIR):
+        """
+        Initialize the recorder and start its encoder
+
+        Args:
+            camera_id: name of the camera
+            fps (float): rate at which frames are pushed
+            frame_size (tuple): (width, height) of the pushed frames
+            pre_roll (float): seconds of frames kept before the first event of a clip
+            post_roll (float): seconds of frames recorded after the last event of a clip
+            output_dir (str): directory the clips are written to
+        """
+        self.camera_id = camera_id
+        self.fps = fps
+        self.frame_size = frame_size
+        self.post_roll = post_roll
+        self.output_dir = output_dir
+        self.pre_roll_frames = deque(maxlen=max(1, int(pre_roll * fps)))
+        # capture time at which the current clip ends, None while no clip is being recorded
+        self.clip_end_time = None
+        self.frames_dropped = CLIP_FRAMES_DROPPED.labels(camera_id)
+        self._encode_queue = queue.Queue(maxsize=self.pre_roll_frames.maxlen + int(CLIP_ENCODE_BACKLOG * fps) + 1)
+        self._encoder_thread = threading.Thread(target=self._encode, name=f"clip-encoder-{camera_id}", daemon=True)
+        self._encoder_thread.start()
+
+    def _enqueue(self, item: tuple, drop_when_full: bool = True):
+        """Hands an item over to the encoder, dropping frames instead of waiting when the encoder falls behind"""
+        if not drop_when_full:
+            self._encode_queue.put(item)
+            return
+        try:
+            self._encode_queue.put_nowait(item)
+        except queue.Full:
+            self.frames_dropped.inc()
+
+    def push(self, frame, capture_time: float):
+        """
+        Adds a frame, either to the current clip or to the pre-roll ring buffer. The frame is kept by reference and
+        must not be modified afterwards.
+
+        Args:
+            frame (numpy.ndarray): the frame
+            capture_time (float): monotonic capture time of the frame
+        """
+        if self.clip_end_time is not None:
+            if capture_time <= self.clip_end_time:
+                self._enqueue(("frame", frame))
+                return
+            self._enqueue(("close", None), drop_when_full=False)
+            self.clip_end_time = None
+        self.pre_roll_frames.append(frame)
+
+    def trigger(self, capture_time: float):
+        """
+        Records an event. It starts a clip with the pre-roll frames, or extends the current clip.
+
+        Args:
+            capture_time (float): monotonic capture time of the frame the event was seen in
+        """
+        if self.clip_end_time is None:
+            camera_name = str(self.camera_id).replace(" ", "_")
+            clip_path = os.path.join(
+                self.output_dir, f"{camera_name}-{time.strftime('%Y%m%d-%H%M%S')}-{int(capture_time * 1000)}.mp4"
+            )
+            self._enqueue(("open", clip_path), drop_when_full=False)
+            for pre_roll_frame in self.pre_roll_frames:
+                self._enqueue(("frame", pre_roll_frame))
+            self.pre_roll_frames.clear()
+            self.clip_end_time = capture_time + self.post_roll
+        else:
+            self.clip_end_time = max(self.clip_end_time, capture_time + self.post_roll)
+
+    def _encode(self):
+        """Writes the clips until the recorder is closed"""
+        video_writer = None
+        clip_path = None
+        while True:
+            action, payload = self._encode_queue.get()
+            if action == "open":
+                os.makedirs(self.output_dir, exist_ok=True)
+                clip_path = payload
+                video_writer = cv2.VideoWriter(
+                    clip_path, cv2.VideoWriter_fourcc(*CLIP_FOURCC), self.fps, self.frame_size
+                )
+            elif action == "frame" and video_writer is not None:
+                video_writer.write(payload)
+            elif action in ("close", "stop"):
+                if video_writer is not None:
+                    video_writer.release()
+                    video_writer = None
+                    CLIPS_WRITTEN.labels(self.camera_id).inc()
+                    print(f"Camera {self.camera_id}: Clip written to {clip_path}")
+                if action == "stop":
+                    break
+
+    def close(self):
+        """Finishes the current clip and stops the encoder"""
+        self._enqueue(("stop", None), drop_when_full=False)
+        self._encoder_thread.join()
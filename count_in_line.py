@@ -1,8 +1,25 @@
+import functools
 import multiprocessing
 import time
 
 import cv2
-from ultralytics import YOLO
+
+from clip_recorder import RECORD_MODE_EVENTS, RECORD_MODE_FULL, ClipRecorder
+from event_sink import EVENTS_DATABASE, EventSink, SqliteBackend, crossing_event, spool_path_for
+from line_roi import LineBandROI
+from model_backends import MODEL_BACKENDS
+from pipeline_metrics import METRICS_PORT, counter, histogram, start_metrics_server
+from preview_server import PREVIEW_PORT, CameraPreview, start_preview_server
+from stage_profiler import install_profiler_signal_handler
+
+# Resolution the frames are resized to for detection and counting
+PROCESS_RESOLUTION = (640, 360)
+
+LINE_CROSSINGS = counter("line_crossings_total", "Objects that crossed the counting line", ("camera", "direction"))
+FRAME_PROCESSING_SECONDS = histogram(
+    "frame_processing_seconds", "Time taken to detect, track and count on a frame", ("camera",)
+)
+DETECTION_INPUT_PIXELS = counter("detection_input_pixels_total", "Pixels of the frames given to the detector", ("camera",))
 
 
 def extend_line(line_start, line_end, img_width, img_height):
@@ -54,7 +71,89 @@ def extend_line(line_start, line_end, img_width, img_height):
 
     return extended_start, extended_end
 
-def process_camera(camera_id, video_source, output_video_path, line_coordinates):
+def is_crossing_line(p1, p2, line_point_1, line_point_2):
+    """
+    Check if object is crossing the line by comparing the sign of the determinant of the two vectors.
+    """
+    d1 = (line_point_2[1] - line_point_1[1]) * p1[0] - (line_point_2[0] - line_point_1[0]) * p1[1] + line_point_2[0] * line_point_1[1] - line_point_2[1] * line_point_1[0]
+    d2 = (line_point_2[1] - line_point_1[1]) * p2[0] - (line_point_2[0] - line_point_1[0]) * p2[1] + line_point_2[0] * line_point_1[1] - line_point_2[1] * line_point_1[0]
+    # print(d1, d2)
+    return d1 * d2 < 0  # Check if signs are opposite, which means it crossed the line
+
+def annotate_frame(frame, detections, counts, line_points, roi_region=None):
+    """
+    Draw the tracked objects, the counts and the counting line on a frame.
+
+    Args:
+        frame (numpy.ndarray): Frame in the processing resolution, drawn on in place.
+        detections (list): Track id, bounding box, center point and confidence of every tracked object.
+        counts (tuple): IN, OUT and INSIDE counts.
+        line_points (tuple): Start and end points of the extended counting line.
+        roi_region (tuple): Optional region detection runs on, as (x1, y1, x2, y2).
+
+    Returns:
+        numpy.ndarray: The annotated frame.
+    """
+    for track_id, (x1, y1, x2, y2), (center_x, center_y), confidence in detections:
+        # Draw the bounding box and center point on the resized frame
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.circle(frame, (center_x, center_y), 5, (0, 0, 255), -1)
+        cv2.putText(frame, f"({center_x}, {center_y})", (center_x + 10 , center_y + 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
+
+        # Display the track_id and confidence near the bounding box
+        cv2.putText(
+            frame,
+            f"ID: {track_id}, Conf: {confidence:.2f}",
+            (x1, y1 - 10),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            0.6,
+            (255, 255, 0),
+            2
+        )
+
+    # Display counts on the resized frame
+    count_in, count_out, people_inside = counts
+    cv2.putText(frame, f"IN: {count_in}", (40, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 1)
+    cv2.putText(frame, f"OUT: {count_out}", (40, 80), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 0, 255), 1)
+    cv2.putText(frame, f"INSIDE: {people_inside}", (40, 120), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255, 255, 0), 1)
+
+    # Draw the counting line on the resized frame
+    cv2.line(frame, line_points[0], line_points[1], (0, 0, 255), 1)
+
+    # Outline the region detection runs on
+    if roi_region is not None:
+        cv2.rectangle(frame, roi_region[:2], roi_region[2:], (255, 0, 255), 1)
+    return frame
+
+def load_model(model_backend):
+    """
+    Load the detection model of a backend. The tests replace it with a stub detector.
+
+    Args:
+        model_backend (str): Detection backend, one of MODEL_BACKENDS.
+
+    Returns:
+        YOLO: The model.
+    """
+    # imported here so that the counting helpers of this module can be used without the detector installed
+    from ultralytics import YOLO
+
+    return YOLO(MODEL_BACKENDS[model_backend], task="detect")
+
+def open_capture(video_source):
+    """
+    Open a video source for processing. The record-and-replay harness replaces it to feed recorded streams.
+
+    Args:
+        video_source (str or int): Path to the video file, stream URL or camera index.
+
+    Returns:
+        cv2.VideoCapture: The opened video source.
+    """
+    return cv2.VideoCapture(video_source)
+
+def process_camera(camera_id, video_source, output_video_path, line_coordinates, metrics_port=None, preview_port=None,
+                   event_backend=None, record_mode=RECORD_MODE_FULL, roi_mode=False, model_backend="tensorrt"):
     """
     Process a single camera feed for object detection, tracking, and counting.
 
@@ -62,19 +161,43 @@ def process_camera(camera_id, video_source, output_video_path, line_coordinates)
         camera_id (int): Unique identifier for the camera.
         video_source (str or int): Path to the video file or camera index.
         output_video_path (str): Path to save the output video.
+        line_coordinates (list): Start and end points of the counting line in the processing resolution.
+        metrics_port (int): Optional local port to serve the metrics of the camera on.
+        preview_port (int): Optional local port to serve a live preview of the annotated frames on.
+        event_backend: Optional event sink backend the crossing events are written to.
+        record_mode (str): "full" to save the whole annotated stream to the output video, "events" to save only clips
+            around the crossings, or "off" to save nothing.
+        roi_mode (bool): Whether to detect only in a band around the counting line, cropped from the original frame.
+        model_backend (str): Detection backend, one of MODEL_BACKENDS.
+
+    Returns:
+        dict: Final IN, OUT and INSIDE counts of the camera.
     """
+    if metrics_port is not None:
+        start_metrics_server(metrics_port)
+    install_profiler_signal_handler()
+    crossings_in = LINE_CROSSINGS.labels(camera_id, "in")
+    crossings_out = LINE_CROSSINGS.labels(camera_id, "out")
+    frame_processing_seconds = FRAME_PROCESSING_SECONDS.labels(camera_id)
+    detection_input_pixels = DETECTION_INPUT_PIXELS.labels(camera_id)
+    event_sink = None if event_backend is None else EventSink(event_backend, spool_path=spool_path_for(camera_id))
+    preview = None
+    if preview_port is not None:
+        preview = CameraPreview()
+        start_preview_server(preview, preview_port)
+
     # Load YOLO model
-    model = YOLO("yolov10x.engine", task="detect")
+    model = load_model(model_backend)
 
     # Open video source
-    cap = cv2.VideoCapture(video_source)
+    cap = open_capture(video_source)
     assert cap.isOpened(), f"Error opening video source {video_source}"
 
     # Get video parameters
     orig_width, orig_height, fps = (int(cap.get(x)) for x in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT, cv2.CAP_PROP_FPS))
 
     # Define reduced processing resolution and output resolution
-    process_width, process_height = 640, 360
+    process_width, process_height = PROCESS_RESOLUTION
     output_width, output_height = 1920, 1080
 
     # Define the line points from the selected points in the original resolution
@@ -85,13 +208,25 @@ def process_camera(camera_id, video_source, output_video_path, line_coordinates)
     extended_line_start, extended_line_end = extend_line(line_start, line_end, process_width,
                                                          process_height)
 
-    # Video writer with the output resolution
-    video_writer = cv2.VideoWriter(
-        output_video_path,
-        cv2.VideoWriter_fourcc(*"mp4v"),
-        fps,
-        (output_width, output_height)
-    )
+    # Region around the line that detection runs on in ROI mode
+    roi = None
+    if roi_mode:
+        roi = LineBandROI((extended_line_start, extended_line_end), (process_width, process_height),
+                          (orig_width, orig_height))
+
+    # Video writer with the output resolution, or a recorder of the clips around the crossings. Every other frame is
+    # processed, so the clips run at half the frame rate of the source.
+    video_writer = None
+    clip_recorder = None
+    if record_mode == RECORD_MODE_FULL:
+        video_writer = cv2.VideoWriter(
+            output_video_path,
+            cv2.VideoWriter_fourcc(*"mp4v"),
+            fps,
+            (output_width, output_height)
+        )
+    elif record_mode == RECORD_MODE_EVENTS:
+        clip_recorder = ClipRecorder(camera_id, fps / 2, (process_width, process_height))
 
     # Initialize counters
     count_in = 0
@@ -102,18 +237,13 @@ def process_camera(camera_id, video_source, output_video_path, line_coordinates)
     # Dictionaries and sets for tracking
     last_positions = {}
 
-    def is_crossing_line(p1, p2, line_point_1, line_point_2):
-        """
-        Check if object is crossing the line by comparing the sign of the determinant of the two vectors.
-        """
-        d1 = (line_point_2[1] - line_point_1[1]) * p1[0] - (line_point_2[0] - line_point_1[0]) * p1[1] + line_point_2[0] * line_point_1[1] - line_point_2[1] * line_point_1[0]
-        d2 = (line_point_2[1] - line_point_1[1]) * p2[0] - (line_point_2[0] - line_point_1[0]) * p2[1] + line_point_2[0] * line_point_1[1] - line_point_2[1] * line_point_1[0]
-        # print(d1, d2)
-        return d1 * d2 < 0  # Check if signs are opposite, which means it crossed the line
-
     frame_count = 0
     while cap.isOpened():
         success, im0 = cap.read()
+        processing_start_time = time.monotonic()
+        # monotonic and wall-clock capture time of the frame, crossing events are stamped with it instead of the
+        # processing time. A replayed recording reports the times the frame was recorded at.
+        capture_time, capture_timestamp = getattr(cap, "last_capture", None) or (processing_start_time, time.time())
         if not success:
             print(f"Camera {camera_id}: Video processing completed or no frame.")
             break
@@ -126,11 +256,18 @@ def process_camera(camera_id, video_source, output_video_path, line_coordinates)
         # Resize frame for processing
         im0_resized = cv2.resize(im0, (process_width, process_height))
 
-        # Run object detection and tracking
-        results = model.track(im0_resized, persist=True, show=False, classes=[0], verbose=False)
+        # Run object detection and tracking, on the whole frame or on the region around the line
+        detection_input = im0_resized if roi is None else roi.crop(im0)
+        detection_input_pixels.inc(detection_input.shape[0] * detection_input.shape[1])
+        results = model.track(detection_input, persist=True, show=False, classes=[0], verbose=False)
 
         # Check if any detections were made
+        detections = []
         if results and results[0].boxes is not None and len(results[0].boxes) > 0:
+            if roi is not None and roi.handover_positions:
+                roi.remove_seen_tracks(
+                    int(box.id.item()) for box in results[0].boxes if getattr(box, 'id', None) is not None
+                )
             for box in results[0].boxes:
                 # Check if box.id exists and is not None
                 if hasattr(box, 'id') and box.id is not None:
@@ -138,25 +275,18 @@ def process_camera(camera_id, video_source, output_video_path, line_coordinates)
 
                     # Get the center coordinates of the bounding box in the reduced resolution
                     x1, y1, x2, y2 = [int(coord.item()) for coord in box.xyxy[0]]
+                    if roi is not None:
+                        x1, y1, x2, y2 = roi.to_frame((x1, y1, x2, y2))
                     center_x = int((x1 + x2) / 2)
                     center_y = int((y1 + y2) / 2)
                     confidence = box.conf.item()  # Confidence score
+                    detections.append((track_id, (x1, y1, x2, y2), (center_x, center_y), confidence))
 
-                    # Draw the bounding box and center point on the resized frame
-                    cv2.rectangle(im0_resized, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                    cv2.circle(im0_resized, (center_x, center_y), 5, (0, 0, 255), -1)
-                    cv2.putText(im0_resized, f"({center_x}, {center_y})", (center_x + 10 , center_y + 10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 255), 1)
-
-                    # Display the track_id and confidence near the bounding box
-                    cv2.putText(
-                        im0_resized,
-                        f"ID: {track_id}, Conf: {confidence:.2f}",
-                        (x1, y1 - 10),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        0.6,
-                        (255, 255, 0),
-                        2
-                    )
+                    # A track that got a new id when the region moved continues from its last position
+                    if roi is not None and track_id not in last_positions:
+                        handed_over_position = roi.handover((center_x, center_y))
+                        if handed_over_position is not None:
+                            last_positions[track_id] = handed_over_position
 
                     # Tracking and counting logic
                     if track_id in last_positions:
@@ -168,52 +298,73 @@ def process_camera(camera_id, video_source, output_video_path, line_coordinates)
                             # Object moving right to left (out)
                             # if last_position[1] < center_y:
                             if last_position[0] < center_x:
-                                print(f"Camera {camera_id}: Object {track_id} went out")
+                                print(f"Camera {camera_id}: Object {track_id} went out (captured at {capture_time:.3f})")
                                 actual_count_out += 1
+                                crossings_out.inc()
+                                if event_sink is not None:
+                                    event_sink.emit(crossing_event(camera_id, track_id, "out", capture_time, capture_timestamp))
+                                if clip_recorder is not None:
+                                    clip_recorder.trigger(capture_time)
                                 if people_inside > 0:
                                     count_out += 1
                             # Object moving left to right (in)
                             else:
-                                print(f"Camera {camera_id}: Object {track_id} came in")
+                                print(f"Camera {camera_id}: Object {track_id} came in (captured at {capture_time:.3f})")
                                 count_in += 1
+                                crossings_in.inc()
+                                if event_sink is not None:
+                                    event_sink.emit(crossing_event(camera_id, track_id, "in", capture_time, capture_timestamp))
+                                if clip_recorder is not None:
+                                    clip_recorder.trigger(capture_time)
 
                     # Update last position
                     last_positions[track_id] = (center_x, center_y)
 
         people_inside = max(0, count_in - count_out)
+        if roi is not None and roi.update([box for _, box, _, _ in detections]):
+            roi.start_handover({track_id: center for track_id, _, center, _ in detections})
+        frame_processing_seconds.observe(time.monotonic() - processing_start_time)
+
+        # Annotate the frame when it is saved, otherwise leave it to the preview, which only annotates watched frames
+        annotate = functools.partial(
+            annotate_frame,
+            detections=detections,
+            counts=(count_in, actual_count_out, people_inside),
+            line_points=(extended_line_start, extended_line_end),
+            roi_region=None if roi is None else roi.region,
+        )
+        if video_writer is not None or clip_recorder is not None:
+            annotate(im0_resized)
+            annotate = None
+        if preview is not None:
+            preview.publish(camera_id, im0_resized, annotate)
 
-        # Display counts on the resized frame
-        cv2.putText(im0_resized, f"IN: {count_in}", (40, 40), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 255, 0), 1)
-        cv2.putText(im0_resized, f"OUT: {actual_count_out}", (40, 80), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (0, 0, 255), 1)
-        cv2.putText(im0_resized, f"INSIDE: {people_inside}", (40, 120), cv2.FONT_HERSHEY_SIMPLEX, 0.75, (255, 255, 0), 1)
-
-        # Draw the counting line on the resized frame
-        # cv2.line(im0_resized, line_start, line_end, (0, 0, 255), 2)
-
-        cv2.line(im0_resized, extended_line_start, extended_line_end, (0, 0, 255), 1)
-
-        # Show the result in real-time
-        cv2.imshow(f"Camera {camera_id} - Real-Time Counting", im0_resized)
-
-        # Resize back to output resolution for saving
-        im0_output = cv2.resize(im0_resized, (output_width, output_height))
-
-        # Write frame to video
-        video_writer.write(im0_output)
+        if video_writer is not None:
+            # Resize back to output resolution for saving
+            im0_output = cv2.resize(im0_resized, (output_width, output_height))
 
-        # Break if 'q' is pressed
-        if cv2.waitKey(1) & 0xFF == ord('q'):
-            print(f"Camera {camera_id}: Exiting on user command.")
-            break
+            # Write frame to video
+            video_writer.write(im0_output)
+        elif clip_recorder is not None:
+            clip_recorder.push(im0_resized, capture_time)
 
     # Release resources
     cap.release()
-    video_writer.release()
-    cv2.destroyAllWindows()
+    if video_writer is not None:
+        video_writer.release()
+    if clip_recorder is not None:
+        clip_recorder.close()
+    if event_sink is not None:
+        event_sink.close()
     print(f"Camera {camera_id}: Processing finished.")
 
+    return {"IN": count_in, "OUT": actual_count_out, "INSIDE": people_inside}
+
 
 if __name__ == "__main__":
+    # The camera processes inherit the handler, so that profiling the process group does not kill any of them
+    install_profiler_signal_handler()
+
     # List of camera sources (video files or camera indices)
     camera_sources = [
         # ("Video 1", "SuperNova-CCTV-Side-Angled.mp4", "SuperNova-CCTV-Side-Angled_Result.mp4", [(742, 1), (822, 717)]),
@@ -229,7 +380,8 @@ if __name__ == "__main__":
     for idx, (camera_name, input_path, output_path, line_points) in enumerate(camera_sources):
         p = multiprocessing.Process(
             target=process_camera,
-            args=(camera_name, input_path, output_path, line_points),
+            args=(camera_name, input_path, output_path, line_points, METRICS_PORT + idx, PREVIEW_PORT + idx,
+                  SqliteBackend(EVENTS_DATABASE)),
         )
         processes.append(p)
         p.start()
@@ -1,11 +1,37 @@
 import cv2
 from ultralytics import YOLO
 import multiprocessing
+import threading
 import time
+from multiprocessing.managers import SyncManager
+
+from clip_recorder import RECORD_MODE_EVENTS, RECORD_MODE_FULL, ClipRecorder, clip_frame_size
+from event_sink import (
+    EVENTS_DATABASE, EventSink, FanoutBackend, QueueBackend, SqliteBackend, crossing_event, spool_path_for
+)
+from occupancy_rollups import OccupancyRollups, start_rollup_server
+from pipeline_metrics import METRICS_PORT, counter, gauge, start_metrics_server
+from stage_profiler import ignore_profile_signal, install_profiler_signal_handler
 
 lock = multiprocessing.Lock()
 
-def process_camera(camera_id, video_source, line_y, output_video_path, people_inside, is_entry_gate):
+LINE_CROSSINGS = counter("line_crossings_total", "Objects that crossed the counting line", ("camera", "direction"))
+PEOPLE_INSIDE = gauge("people_inside", "People inside the room as seen by the camera")
+
+def open_capture(video_source):
+    """
+    Open a video source for processing. The record-and-replay harness replaces it to feed recorded streams.
+
+    Args:
+        video_source (str or int): Path to the video file, stream URL or camera index.
+
+    Returns:
+        cv2.VideoCapture: The opened video source.
+    """
+    return cv2.VideoCapture(video_source)
+
+def process_camera(camera_id, video_source, line_y, output_video_path, people_inside, is_entry_gate,
+                   metrics_port=None, event_backend=None, record_mode=RECORD_MODE_FULL):
     """
     Process a single camera feed for object detection, tracking, and counting.
 
@@ -16,12 +42,22 @@ def process_camera(camera_id, video_source, line_y, output_video_path, people_in
         output_video_path (str): Path to save the output video.
         people_inside (multiprocessing.Value): Shared counter for people inside the room.
         is_entry_gate (bool): True if this camera is for the entry gate, False if for the exit gate.
+        metrics_port (int): Optional local port to serve the metrics of the camera on.
+        event_backend: Optional event sink backend the crossing events are written to.
+        record_mode (str): "full" to save the whole annotated stream to the output video, "events" to save only clips
+            around the crossings, or "off" to save nothing.
     """
+    if metrics_port is not None:
+        start_metrics_server(metrics_port)
+    install_profiler_signal_handler()
+    crossings = LINE_CROSSINGS.labels(camera_id, "in" if is_entry_gate else "out")
+    event_sink = None if event_backend is None else EventSink(event_backend, spool_path=spool_path_for(camera_id))
+
     # Load YOLO model
     model = YOLO("yolov8x.engine", task="detect")
 
     # Open video source
-    cap = cv2.VideoCapture(video_source)
+    cap = open_capture(video_source)
     assert cap.isOpened(), f"Error opening video source {video_source}"
 
     # Get video parameters
@@ -31,19 +67,28 @@ def process_camera(camera_id, video_source, line_y, output_video_path, people_in
     frame_width = w
     line_points = [(0, line_y), (frame_width - 1, line_y)]
 
-    # Video writer
-    video_writer = cv2.VideoWriter(
-        output_video_path,
-        cv2.VideoWriter_fourcc(*"mp4v"),
-        fps,
-        (w, h)
-    )
+    # Video writer, or a recorder of the clips around the crossings, which keeps downscaled frames in memory
+    video_writer = None
+    clip_recorder = None
+    clip_size = clip_frame_size((w, h))
+    if record_mode == RECORD_MODE_FULL:
+        video_writer = cv2.VideoWriter(
+            output_video_path,
+            cv2.VideoWriter_fourcc(*"mp4v"),
+            fps,
+            (w, h)
+        )
+    elif record_mode == RECORD_MODE_EVENTS:
+        clip_recorder = ClipRecorder(camera_id, fps, clip_size)
 
     # Dictionaries and sets for tracking
     last_positions = {}
 
     while cap.isOpened():
         success, im0 = cap.read()
+        # monotonic and wall-clock capture time of the frame, crossing events are stamped with it instead of the
+        # processing time. A replayed recording reports the times the frame was recorded at.
+        capture_time, capture_timestamp = getattr(cap, "last_capture", None) or (time.monotonic(), time.time())
         if not success:
             print(f"Camera {camera_id}: Video processing completed or no frame.")
             break
@@ -85,13 +130,23 @@ def process_camera(camera_id, video_source, line_y, output_video_path, people_in
 
                         # Entry gate logic (object moving downwards)
                         if is_entry_gate and last_y < line_y <= center_y:
-                            print(f"Camera {camera_id}: Object {track_id} came in")
+                            print(f"Camera {camera_id}: Object {track_id} came in (captured at {capture_time:.3f})")
+                            crossings.inc()
+                            if event_sink is not None:
+                                event_sink.emit(crossing_event(camera_id, track_id, "in", capture_time, capture_timestamp))
+                            if clip_recorder is not None:
+                                clip_recorder.trigger(capture_time)
                             with lock:  # Lock automatically handled by Value
                                 people_inside.value += 1
 
                         # Exit gate logic (object moving upwards)
                         elif not is_entry_gate and last_y > line_y >= center_y:
-                            print(f"Camera {camera_id}: Object {track_id} went out")
+                            print(f"Camera {camera_id}: Object {track_id} went out (captured at {capture_time:.3f})")
+                            crossings.inc()
+                            if event_sink is not None:
+                                event_sink.emit(crossing_event(camera_id, track_id, "out", capture_time, capture_timestamp))
+                            if clip_recorder is not None:
+                                clip_recorder.trigger(capture_time)
                             with lock:  # Lock automatically handled by Value
                                 if people_inside.value > 0:
                                     people_inside.value -= 1
@@ -100,13 +155,17 @@ def process_camera(camera_id, video_source, line_y, output_video_path, people_in
                     last_positions[track_id] = center_y
 
         # Display counts
+        PEOPLE_INSIDE.set(people_inside.value)
         cv2.putText(im0, f"INSIDE: {people_inside.value}", (50, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 0), 2)
 
         # Draw the counting line
         cv2.line(im0, line_points[0], line_points[1], (0, 0, 255), 2)
 
         # Write frame to video
-        video_writer.write(im0)
+        if video_writer is not None:
+            video_writer.write(im0)
+        elif clip_recorder is not None:
+            clip_recorder.push(cv2.resize(im0, clip_size) if clip_size != (w, h) else im0, capture_time)
 
         # # Show the result in real-time
         # im0 = cv2.resize(im0, (640, 360))
@@ -119,15 +178,34 @@ def process_camera(camera_id, video_source, line_y, output_video_path, people_in
 
     # Release resources
     cap.release()
-    video_writer.release()
+    if video_writer is not None:
+        video_writer.release()
+    if clip_recorder is not None:
+        clip_recorder.close()
     cv2.destroyAllWindows()
+    if event_sink is not None:
+        event_sink.close()
     print(f"Camera {camera_id}: Processing finished.")
 
 if __name__ == "__main__":
+    # The camera processes inherit the handler, and the manager ignores the signal, so that profiling the process group
+    # does not kill any of them
+    install_profiler_signal_handler()
+    manager = SyncManager()
+    manager.start(ignore_profile_signal)
+
     # Shared variable to track people inside the room
-    with multiprocessing.Manager() as manager:
+    with manager:
         people_inside = manager.Value('i', 0)  # 'i' means integer
 
+        # Room occupancy rollups over the events of all the gates, served over the local rollup API
+        events_queue = multiprocessing.Queue()
+        rollups = OccupancyRollups()
+        rollup_thread = threading.Thread(target=rollups.consume, args=(events_queue,), daemon=True)
+        rollup_thread.start()
+        start_rollup_server(rollups)
+        event_backend = FanoutBackend([SqliteBackend(EVENTS_DATABASE), QueueBackend(events_queue)])
+
         # List of camera sources (video files or camera indices)
         camera_sources = [
             ("Camera 1", "entry_video.mp4", 400, "output_entry.avi", True),  # Entry gate
@@ -142,7 +220,8 @@ if __name__ == "__main__":
         for idx, (camera_name, video_source, line_y, output_video_path, is_entry_gate) in enumerate(camera_sources):
             p = multiprocessing.Process(
                 target=process_camera,
-                args=(camera_name, video_source, line_y, output_video_path, people_inside, is_entry_gate)
+                args=(camera_name, video_source, line_y, output_video_path, people_inside, is_entry_gate,
+                      METRICS_PORT + idx, event_backend)
             )
             processes.append(p)
             p.start()
@@ -152,5 +231,9 @@ if __name__ == "__main__":
         for p in processes:
             p.join()
 
+        events_queue.put(None)
+        rollup_thread.join()
+
         print(f"Final count of people inside: {people_inside.value}")
+        print(f"Room occupancy from the rollups: {rollups.occupancy}")
         print("All camera processes have completed.")
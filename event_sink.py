@@ -0,0 +1,288 @@
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from pipeline_metrics import counter, gauge, histogram
+
+EVENT_QUEUE_SIZE = 10000
+EVENT_BATCH_SIZE = 256
+EVENT_FLUSH_INTERVAL = 1.0
+EVENT_MAX_RETRIES = 3
+EVENT_RETRY_BACKOFF = 0.5
+# Fraction of the queue above which the events are spooled to disk instead of waiting for the backend
+EVENT_SPOOL_HIGH_WATER_RATIO = 0.8
+# Every sink spools to a file of its own, named after its camera, or after its process by default
+EVENT_SPOOL_PATH_TEMPLATE = "event_spool-{}.jsonl"
+EVENTS_DATABASE = "events.db"
+EVENTS_TOPIC = "crossing-events"
+
+EVENTS_EMITTED = counter("events_emitted_total", "Events handed to the event sink")
+EVENTS_FLUSHED = counter("events_flushed_total", "Events written to the backend")
+EVENTS_SPOOLED = counter("events_spooled_total", "Events spooled to disk while the backend was slow or failing")
+EVENTS_DROPPED = counter("events_dropped_total", "Events dropped because the event queue was full")
+EVENT_FLUSH_FAILURES = counter("event_flush_failures_total", "Failed attempts to write a batch to the backend")
+EVENT_FLUSH_SECONDS = histogram("event_flush_seconds", "Time taken to write a batch to the backend")
+EVENT_QUEUE_DEPTH = gauge("event_queue_depth", "Events waiting in the event queue")
+
+
+def spool_path_for(name) -> str:
+    """Returns the spool file of the sink of a camera or process"""
+    return EVENT_SPOOL_PATH_TEMPLATE.format(str(name).replace(" ", "_").replace(os.sep, "_"))
+
+
+def crossing_event(camera_id, track_id: int, direction: str, capture_time: float, timestamp: float) -> dict:
+    """
+    Creates a line crossing event
+
+    Args:
+        camera_id: name of the camera that saw the crossing
+        track_id (int): id of the tracked object
+        direction (str): "in" or "out"
+        capture_time (float): monotonic capture time of the frame the crossing was seen in
+        timestamp (float): wall clock time of the capture, in seconds since the epoch
+
+    Returns:
+        dict: the event
+    """
+    return {
+        "camera": camera_id,
+        "track_id": track_id,
+        "direction": direction,
+        "capture_time": capture_time,
+        "timestamp": timestamp,
+    }
+
+
+class JsonlBackend:
+    """A class to represent a backend that appends the events to a JSON lines file"""
+
+    def __init__(self, path: str):
+        """Initialize the backend"""
+        self.path = path
+
+    def write_batch(self, events: list):
+        """Appends a batch of events to the file"""
+        with open(self.path, "a") as events_file:
+            events_file.write("".join(json.dumps(event) + "\n" for event in events))
+
+
+class SqliteBackend:
+    """A class to represent a backend that stores the events in an SQLite database"""
+
+    def __init__(self, path: str = EVENTS_DATABASE):
+        """Initialize the backend. The connection is opened by the thread that writes the first batch."""
+        self.path = path
+        self.connection = None
+
+    def write_batch(self, events: list):
+        """Inserts a batch of events in one transaction"""
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, timeout=30)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "camera TEXT, track_id INTEGER, direction TEXT, capture_time REAL, timestamp REAL)"
+            )
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO events (camera, track_id, direction, capture_time, timestamp) "
+                "VALUES (:camera, :track_id, :direction, :capture_time, :timestamp)",
+                events,
+            )
+
+
+class KafkaBackend:
+    """
+    A class to represent a backend that publishes the events to Kafka. Any producer with the `send(topic, value, key)`
+    and `flush()` methods of kafka-python's KafkaProducer can be used, e.g. LocalKafkaProducer in tests.
+    """
+
+    def __init__(self, producer, topic: str = EVENTS_TOPIC):
+        """Initialize the backend"""
+        self.producer = producer
+        self.topic = topic
+
+    def write_batch(self, events: list):
+        """Publishes a batch of events keyed by camera and waits until they are acknowledged"""
+        for event in events:
+            self.producer.send(
+                self.topic, value=json.dumps(event).encode("utf-8"), key=str(event["camera"]).encode("utf-8")
+            )
+        self.producer.flush()
+
+
+class LocalKafkaProducer:
+    """A class to represent an in-memory stand-in for a Kafka producer"""
+
+    def __init__(self):
+        """Initialize the producer"""
+        self.messages = {}
+
+    def send(self, topic: str, value: bytes = None, key: bytes = None):
+        """Stores a message in the topic"""
+        self.messages.setdefault(topic, []).append((key, value))
+
+    def flush(self):
+        """Nothing to flush since the messages are stored on send"""
+        pass
+
+
+class QueueBackend:
+    """A class to represent a backend that hands the batches over to another process through a multiprocessing queue"""
+
+    def __init__(self, events_queue):
+        """Initialize the backend"""
+        self.events_queue = events_queue
+
+    def write_batch(self, events: list):
+        """Places a batch of events in the queue"""
+        self.events_queue.put(events)
+
+
+class FanoutBackend:
+    """
+    A class to represent a backend that writes every batch to several backends. A failed batch is retried on all of
+    them, so the backends before the failing one may see a batch twice.
+    """
+
+    def __init__(self, backends: list):
+        """Initialize the backend"""
+        self.backends = backends
+
+    def write_batch(self, events: list):
+        """Writes a batch of events to all the backends"""
+        for backend in self.backends:
+            backend.write_batch(events)
+
+
+class EventSink:
+    """
+    A class to represent a non-blocking sink for events. `emit` only places the event in a bounded in-memory queue. A
+    background thread writes the events to the backend in batches, retries failed batches, and spools them to disk when
+    the backend keeps failing or falls behind, so that memory stays bounded. Spooled events are written to the backend
+    once it catches up again. Spooled events are delivered at least once: a crash while draining the spool may write
+    some of them twice.
+    """
+
+    def __init__(self, backend, queue_size: int = EVENT_QUEUE_SIZE, batch_size: int = EVENT_BATCH_SIZE,
+                 flush_interval: float = EVENT_FLUSH_INTERVAL, spool_path: str = None):
+        """
+        Initialize the sink and start its flushing thread. The spool file must not be shared with another sink, and
+        defaults to one named after the process.
+        """
+        self.backend = backend
+        self.events = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_path = spool_path_for(os.getpid()) if spool_path is None else spool_path
+        self.draining_path = f"{self.spool_path}.draining"
+        self.spool_high_water = int(queue_size * EVENT_SPOOL_HIGH_WATER_RATIO)
+        self._stop_event = threading.Event()
+        self._flush_thread = threading.Thread(target=self._run, name="event-sink", daemon=True)
+        self._flush_thread.start()
+
+    def emit(self, event: dict):
+        """Hands an event over to the sink without blocking"""
+        try:
+            self.events.put_nowait(event)
+            EVENTS_EMITTED.inc()
+        except queue.Full:
+            EVENTS_DROPPED.inc()
+
+    def _next_batch(self) -> list:
+        """Waits for the first event of a batch for at most the flush interval, then takes what is waiting"""
+        batch = []
+        try:
+            batch.append(self.events.get(timeout=self.flush_interval))
+            while len(batch) < self.batch_size:
+                batch.append(self.events.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write(self, batch: list) -> bool:
+        """Writes a batch to the backend, retrying with exponential backoff"""
+        for attempt in range(EVENT_MAX_RETRIES):
+            flush_start_time = time.monotonic()
+            try:
+                self.backend.write_batch(batch)
+            except Exception as error:
+                EVENT_FLUSH_FAILURES.inc()
+                print(f"Writing {len(batch)} events failed due to {error} (attempt {attempt + 1})")
+                if self._stop_event.is_set():
+                    break
+                time.sleep(EVENT_RETRY_BACKOFF * 2 ** attempt)
+                continue
+            EVENT_FLUSH_SECONDS.observe(time.monotonic() - flush_start_time)
+            EVENTS_FLUSHED.inc(len(batch))
+            return True
+        return False
+
+    def _spool(self, batch: list):
+        """Appends a batch to the spool file"""
+        with open(self.spool_path, "a") as spool_file:
+            spool_file.write("".join(json.dumps(event) + "\n" for event in batch))
+        EVENTS_SPOOLED.inc(len(batch))
+
+    def _has_spooled_events(self) -> bool:
+        """Returns whether events are waiting in the spool, including a drain that was interrupted"""
+        return os.path.exists(self.draining_path) or os.path.exists(self.spool_path)
+
+    def _drain_spool(self):
+        """
+        Writes the spooled events to the backend. The events being drained stay on disk until they are written, and the
+        ones that still fail are kept for the next drain.
+        """
+        # an interrupted drain is finished first, the events spooled since then wait in the spool
+        if not os.path.exists(self.draining_path):
+            os.replace(self.spool_path, self.draining_path)
+        with open(self.draining_path) as spool_file:
+            spooled_events = [json.loads(line) for line in spool_file if line.strip()]
+
+        for start in range(0, len(spooled_events), self.batch_size):
+            batch = spooled_events[start:start + self.batch_size]
+            if not self._write(batch):
+                remaining_path = f"{self.draining_path}.remaining"
+                with open(remaining_path, "w") as remaining_file:
+                    remaining_file.write("".join(json.dumps(event) + "\n" for event in spooled_events[start:]))
+                os.replace(remaining_path, self.draining_path)
+                return False
+        os.remove(self.draining_path)
+        return True
+
+    def _flush_once(self, backend_healthy: bool) -> bool:
+        """Writes or spools the next batch, then drains the spool when there is time, and returns the backend health"""
+        batch = self._next_batch()
+        EVENT_QUEUE_DEPTH.set(self.events.qsize())
+        if batch:
+            # when the backend falls behind, keep the queue short by spooling instead of waiting on it
+            if self.events.qsize() > self.spool_high_water:
+                self._spool(batch)
+                return backend_healthy
+            backend_healthy = self._write(batch)
+            if not backend_healthy:
+                self._spool(batch)
+        # catch up on the spooled events once the backend works and the live events are written
+        if (backend_healthy or not batch) and self.events.empty() and self._has_spooled_events():
+            backend_healthy = self._drain_spool()
+        return backend_healthy
+
+    def _run(self):
+        """Flushes the events until the sink is closed and the queue is empty"""
+        backend_healthy = True
+        while not (self._stop_event.is_set() and self.events.empty()):
+            try:
+                backend_healthy = self._flush_once(backend_healthy)
+            except Exception as error:
+                # e.g. a full disk while spooling, the thread keeps going so that the events are not silently dropped
+                EVENT_FLUSH_FAILURES.inc()
+                print(f"Flushing events failed due to {error}")
+                backend_healthy = False
+                time.sleep(EVENT_RETRY_BACKOFF)
+
+    def close(self):
+        """Flushes the remaining events and stops the sink"""
+        self._stop_event.set()
+        self._flush_thread.join()
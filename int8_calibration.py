@@ -0,0 +1,220 @@
+import argparse
+import json
+import os
+
+import cv2
+import numpy
+
+from model_backends import MODEL_BACKENDS
+from record_replay import RECORDING_METADATA_FILE, counting_lines, load_golden, video_path
+
+# Input size of the exported detector, the frames are letterboxed to it like ultralytics does
+CALIBRATION_INPUT_SIZE = 640
+CALIBRATION_FRAMES_PER_CAMERA = 64
+# Batch size of the calibration for models with a dynamic batch dimension, fixed ones are fed their own batch size
+CALIBRATION_BATCH_SIZE = 8
+CALIBRATION_SET_PATH = "calibration_frames.npy"
+LETTERBOX_FILL_VALUE = 114
+
+
+def letterbox(frame, size: int = CALIBRATION_INPUT_SIZE):
+    """
+    Resizes a frame to fit a square detector input, keeping its aspect ratio and padding it evenly on both sides
+
+    Args:
+        frame (numpy.ndarray): frame in BGR
+        size (int): side of the detector input
+
+    Returns:
+        numpy.ndarray: the letterboxed frame
+    """
+    height, width = frame.shape[:2]
+    scale = min(size / height, size / width)
+    resized_width, resized_height = round(width * scale), round(height * scale)
+    resized = cv2.resize(frame, (resized_width, resized_height), interpolation=cv2.INTER_LINEAR)
+    canvas = numpy.full((size, size, 3), LETTERBOX_FILL_VALUE, dtype=numpy.uint8)
+    left, top = (size - resized_width) // 2, (size - resized_height) // 2
+    canvas[top:top + resized_height, left:left + resized_width] = resized
+    return canvas
+
+
+def build_calibration_set(recording_dirs: list, frames_per_camera: int = CALIBRATION_FRAMES_PER_CAMERA,
+                          output_path: str = CALIBRATION_SET_PATH) -> int:
+    """
+    Samples frames evenly over every camera of our recordings and stores them letterboxed as the calibration set
+
+    Args:
+        recording_dirs (list): directories of recordings made with record_replay.py
+        frames_per_camera (int): number of frames to sample from every recorded camera
+        output_path (str): .npy file the frames are stored in, as uint8 BGR images
+
+    Returns:
+        int: number of frames in the calibration set
+    """
+    calibration_frames = []
+    for recording_dir in recording_dirs:
+        with open(os.path.join(recording_dir, RECORDING_METADATA_FILE)) as metadata_file:
+            metadata = json.load(metadata_file)
+        for cam_name, camera_metadata in metadata.items():
+            stream = cv2.VideoCapture(video_path(recording_dir, cam_name))
+            frame_numbers = numpy.linspace(0, camera_metadata["frames"] - 1, frames_per_camera).astype(int)
+            for frame_number in sorted(set(frame_numbers)):
+                stream.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
+                grabbed, frame = stream.read()
+                if grabbed:
+                    calibration_frames.append(letterbox(frame))
+            stream.release()
+            print(f"Sampled calibration frames from {cam_name} of {recording_dir}")
+
+    numpy.save(output_path, numpy.stack(calibration_frames))
+    print(f"Calibration set of {len(calibration_frames)} frames written to {output_path}")
+    return len(calibration_frames)
+
+
+class CalibrationDataReader:
+    """
+    A class to represent the calibration set as the batches of model inputs that onnxruntime's quantize_static reads
+    through `get_next`. Every batch has exactly the batch size, so that a model with a fixed batch dimension accepts it.
+    """
+
+    def __init__(self, calibration_set_path: str, input_name: str, batch_size: int = CALIBRATION_BATCH_SIZE):
+        """Initialize the reader"""
+        self.frames = numpy.load(calibration_set_path, mmap_mode="r")
+        self.input_name = input_name
+        self.batch_size = batch_size
+        self.position = 0
+
+    def get_next(self):
+        """Returns the next batch as RGB, NCHW, float32 in [0, 1] like the ultralytics preprocessing, or None"""
+        # the frames that do not fill a last batch are left out
+        if self.position + self.batch_size > len(self.frames):
+            return None
+        batch = numpy.asarray(self.frames[self.position:self.position + self.batch_size])
+        self.position += self.batch_size
+        batch = batch[..., ::-1].transpose(0, 3, 1, 2).astype(numpy.float32) / 255.0
+        return {self.input_name: numpy.ascontiguousarray(batch)}
+
+    def rewind(self):
+        """Starts reading from the first batch again"""
+        self.position = 0
+
+
+def quantize_model(fp32_model_path: str, calibration_set_path: str = CALIBRATION_SET_PATH,
+                   int8_model_path: str = MODEL_BACKENDS["onnx-int8"], nodes_to_exclude: list = None) -> str:
+    """
+    Statically quantizes an FP32 ONNX detector to INT8 with QDQ nodes and per-channel weights, calibrated on our frames
+
+    Args:
+        fp32_model_path (str): FP32 ONNX model, or a .pt model that is exported to ONNX first
+        calibration_set_path (str): calibration set built by build_calibration_set
+        int8_model_path (str): path of the INT8 model
+        nodes_to_exclude (list): names of nodes kept in FP32, e.g. the box decoding of the detection head
+
+    Returns:
+        str: path of the INT8 model
+    """
+    try:
+        import onnxruntime
+        from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+        from onnxruntime.quantization.shape_inference import quant_pre_process
+    except ImportError as error:
+        raise ImportError("Quantizing the model requires onnxruntime, install it with `pip install onnxruntime`") \
+            from error
+
+    if fp32_model_path.endswith(".pt"):
+        from ultralytics import YOLO
+        fp32_model_path = YOLO(fp32_model_path).export(format="onnx", imgsz=CALIBRATION_INPUT_SIZE, dynamic=False)
+
+    preprocessed_model_path = f"{os.path.splitext(int8_model_path)[0]}_preprocessed.onnx"
+    quant_pre_process(fp32_model_path, preprocessed_model_path)
+    model_input = onnxruntime.InferenceSession(
+        preprocessed_model_path, providers=["CPUExecutionProvider"]
+    ).get_inputs()[0]
+    # the batch dimension is a name or None when it is dynamic
+    batch_size = model_input.shape[0] if isinstance(model_input.shape[0], int) else CALIBRATION_BATCH_SIZE
+
+    quantize_static(
+        preprocessed_model_path,
+        int8_model_path,
+        CalibrationDataReader(calibration_set_path, model_input.name, batch_size),
+        quant_format=QuantFormat.QDQ,
+        per_channel=True,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        calibrate_method=CalibrationMethod.MinMax,
+        nodes_to_exclude=nodes_to_exclude or [],
+    )
+    os.remove(preprocessed_model_path)
+    print(f"INT8 model written to {int8_model_path}")
+    return int8_model_path
+
+
+def evaluate(recording_dir: str, lines: dict, backends: tuple = ("onnx-fp32", "onnx-int8")) -> dict:
+    """
+    Replays a recording through count_in_line with every backend and compares their latency and counts with the first
+
+    Args:
+        recording_dir (str): directory of the recording
+        lines (dict): names of the cameras mapped to their counting lines
+        backends (tuple): backends to compare, the first one being the reference
+
+    Returns:
+        dict: names of the cameras mapped to the statistics of every backend and whether its counts match the reference
+    """
+    # the replay runs the detector, which calibrating and quantizing do without
+    from benchmark_roi import replay_with_stats
+
+    backend_stats = {backend: replay_with_stats(recording_dir, lines, model_backend=backend) for backend in backends}
+    reference = backend_stats[backends[0]]
+    return {
+        cam_name: {
+            backend: dict(
+                stats[cam_name],
+                latency_ratio=stats[cam_name]["latency_mean"] / reference[cam_name]["latency_mean"],
+                counts_match_reference=stats[cam_name]["counts"] == reference[cam_name]["counts"],
+            )
+            for backend, stats in backend_stats.items()
+        }
+        for cam_name in lines
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an INT8 ONNX detector calibrated on our recordings")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    calibrate_parser = subparsers.add_parser("calibrate", help="build the calibration set from recordings")
+    calibrate_parser.add_argument("recording_dirs", nargs="+")
+    calibrate_parser.add_argument("--frames-per-camera", type=int, default=CALIBRATION_FRAMES_PER_CAMERA)
+    calibrate_parser.add_argument("--output", default=CALIBRATION_SET_PATH)
+
+    quantize_parser = subparsers.add_parser("quantize", help="quantize an FP32 ONNX or .pt model to INT8")
+    quantize_parser.add_argument("fp32_model")
+    quantize_parser.add_argument("--calibration-set", default=CALIBRATION_SET_PATH)
+    quantize_parser.add_argument("--output", default=MODEL_BACKENDS["onnx-int8"])
+    quantize_parser.add_argument("--exclude-node", action="append", default=[], help="node kept in FP32")
+
+    evaluate_parser = subparsers.add_parser("evaluate", help="compare the latency and counts of the backends")
+    evaluate_parser.add_argument("recording_dir")
+    evaluate_parser.add_argument("--line", action="append", default=[], help="count_in_line camera as name=x1,y1,x2,y2")
+    evaluate_parser.add_argument("--backends", default="onnx-fp32,onnx-int8", help="comma separated backends")
+    args = parser.parse_args()
+
+    if args.command == "calibrate":
+        build_calibration_set(args.recording_dirs, args.frames_per_camera, args.output)
+    elif args.command == "quantize":
+        quantize_model(args.fp32_model, args.calibration_set, args.output, args.exclude_node)
+    else:
+        lines = counting_lines(load_golden(args.recording_dir), args.line)
+        backends = tuple(args.backends.split(","))
+        for cam_name, results in evaluate(args.recording_dir, lines, backends).items():
+            for backend, result in results.items():
+                print(
+                    f"{cam_name} {backend}: {result['latency_mean'] * 1000:.1f} ms per frame "
+                    f"({result['latency_ratio']:.2f}x of {backends[0]}), counts {result['counts']} "
+                    f"(match {backends[0]}: {result['counts_match_reference']})"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import cv2
+
+# Margin in pixels of the processing resolution around the counting line
+ROI_PADDING = 64
+# Detection input pixels per processing pixel along each side, above 1 to detect at a higher effective resolution
+ROI_SCALE = 1.0
+# The region snaps to multiples of this many pixels, which is also the stride of the detector
+ROI_ALIGNMENT = 32
+# A box closer than this to an inner edge of the region is cut by the edge
+ROI_EDGE_MARGIN = 8
+# Processed frames without cut boxes before a grown region shrinks back
+ROI_SHRINK_FRAMES = 30
+# A new track within this distance of a track from before a region change takes over its last position
+ROI_HANDOVER_DISTANCE = 48
+ROI_HANDOVER_FRAMES = 10
+
+
+class LineBandROI:
+    """
+    A class to represent the region of the frame around a counting line that detection runs on. The region starts as
+    a padded band around the line and grows past an inner edge when a tracked object reaches it, so that objects
+    coming from outside the band are seen whole before they reach the line. It shrinks back once nobody is at its
+    edges. Coordinates are in the processing resolution, while the region is cropped out of the original frame.
+    """
+
+    def __init__(self, line_points, process_size: tuple, original_size: tuple, padding: int = ROI_PADDING,
+                 scale: float = ROI_SCALE):
+        """
+        Initialize the region
+
+        Args:
+            line_points (tuple): start and end points of the extended counting line
+            process_size (tuple): (width, height) of the processing resolution
+            original_size (tuple): (width, height) of the original frames
+            padding (int): margin around the line
+            scale (float): detection input pixels per processing pixel along each side
+        """
+        self.process_width, self.process_height = process_size
+        self.scale_x = original_size[0] / self.process_width
+        self.scale_y = original_size[1] / self.process_height
+        self.padding = padding
+        self.scale = scale
+        (x1, y1), (x2, y2) = line_points
+        self.base_region = self._aligned((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)))
+        self.region = self.base_region
+        self.frames_without_cut_boxes = 0
+        self.frames_since_change = 0
+        self.handover_positions = {}
+
+    def _aligned(self, region: tuple) -> tuple:
+        """Pads a region, snaps it to the alignment and clips it to the frame"""
+        x1, y1, x2, y2 = region
+        return (
+            max(0, int((x1 - self.padding) // ROI_ALIGNMENT * ROI_ALIGNMENT)),
+            max(0, int((y1 - self.padding) // ROI_ALIGNMENT * ROI_ALIGNMENT)),
+            min(self.process_width, int(-(-(x2 + self.padding) // ROI_ALIGNMENT) * ROI_ALIGNMENT)),
+            min(self.process_height, int(-(-(y2 + self.padding) // ROI_ALIGNMENT) * ROI_ALIGNMENT)),
+        )
+
+    def crop(self, frame):
+        """
+        Cuts the region out of an original frame and resizes it to the detection input
+
+        Args:
+            frame (numpy.ndarray): frame in the original resolution
+
+        Returns:
+            numpy.ndarray: the detection input
+        """
+        x1, y1, x2, y2 = self.region
+        crop = frame[int(y1 * self.scale_y):int(y2 * self.scale_y), int(x1 * self.scale_x):int(x2 * self.scale_x)]
+        return cv2.resize(crop, (round((x2 - x1) * self.scale), round((y2 - y1) * self.scale)))
+
+    def to_frame(self, box: tuple) -> tuple:
+        """Maps a box from the detection input to the processing resolution"""
+        x1, y1, x2, y2 = box
+        return (
+            int(self.region[0] + x1 / self.scale),
+            int(self.region[1] + y1 / self.scale),
+            int(self.region[0] + x2 / self.scale),
+            int(self.region[1] + y2 / self.scale),
+        )
+
+    def _is_cut(self, box: tuple) -> bool:
+        """Returns whether a box touches an edge of the region that is not an edge of the frame"""
+        x1, y1, x2, y2 = self.region
+        return (
+            (x1 > 0 and box[0] - x1 < ROI_EDGE_MARGIN)
+            or (y1 > 0 and box[1] - y1 < ROI_EDGE_MARGIN)
+            or (x2 < self.process_width and x2 - box[2] < ROI_EDGE_MARGIN)
+            or (y2 < self.process_height and y2 - box[3] < ROI_EDGE_MARGIN)
+        )
+
+    def update(self, boxes: list) -> bool:
+        """
+        Adapts the region to the boxes of the tracked objects
+
+        Args:
+            boxes (list): boxes of the tracked objects in the processing resolution
+
+        Returns:
+            bool: whether the region changed
+        """
+        self.frames_since_change += 1
+        region = self.region
+        cut_boxes = [box for box in boxes if self._is_cut(box)]
+        if cut_boxes:
+            self.frames_without_cut_boxes = 0
+            region = self._union(self.region, cut_boxes)
+        elif self.region != self.base_region:
+            self.frames_without_cut_boxes += 1
+            if self.frames_without_cut_boxes >= ROI_SHRINK_FRAMES:
+                # shrink back, but keep the objects that are being tracked inside
+                self.frames_without_cut_boxes = 0
+                region = self._union(self.base_region, boxes)
+        if region == self.region:
+            return False
+        self.region = region
+        self.frames_since_change = 0
+        return True
+
+    def _union(self, region: tuple, boxes: list) -> tuple:
+        """Returns the aligned region that covers a region and padded boxes"""
+        for box in boxes:
+            box = self._aligned(box)
+            region = (min(region[0], box[0]), min(region[1], box[1]), max(region[2], box[2]), max(region[3], box[3]))
+        return region
+
+    def start_handover(self, track_positions: dict):
+        """
+        Keeps the positions of the tracks of the frame that changed the region. The tracker sees the objects jump when
+        the region moves, so it may give them new track ids.
+
+        Args:
+            track_positions (dict): track ids of the frame mapped to their center points
+        """
+        self.handover_positions = dict(track_positions)
+
+    def remove_seen_tracks(self, track_ids):
+        """
+        Removes the tracks that are seen again under their id since the region changed, so that only the positions
+        of tracks that disappeared are handed over and a new track never takes over an object that is still tracked
+
+        Args:
+            track_ids (iterable): track ids of the current frame
+        """
+        for track_id in track_ids:
+            self.handover_positions.pop(track_id, None)
+
+    def handover(self, center: tuple):
+        """
+        Returns the last position of the track from before the region changed that is nearest to a new track
+
+        Args:
+            center (tuple): center point of the new track
+
+        Returns:
+            tuple: the last position, or None if no track from before the change was close enough
+        """
+        if not self.handover_positions or self.frames_since_change > ROI_HANDOVER_FRAMES:
+            return None
+        track_id, position = min(
+            self.handover_positions.items(),
+            key=lambda item: (item[1][0] - center[0]) ** 2 + (item[1][1] - center[1]) ** 2,
+        )
+        if (position[0] - center[0]) ** 2 + (position[1] - center[1]) ** 2 > ROI_HANDOVER_DISTANCE ** 2:
+            return None
+        del self.handover_positions[track_id]
+        return position
@@ -0,0 +1,181 @@
+import time
+
+from pipeline_metrics import counter, gauge
+
+# Camera priorities. Cameras with a higher priority are degraded last and restored first.
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_CRITICAL = 2
+
+# Entrance-door cameras must keep counting accurately, corridor cameras may slow down
+CAMERA_PRIORITIES = {
+    "cam-1": PRIORITY_CRITICAL,
+    "cam-2": PRIORITY_NORMAL,
+}
+
+# Degradation steps applied to a camera, in order
+LEVEL_NORMAL = 0
+LEVEL_RAISED_STRIDE = 1
+LEVEL_REDUCED_RESOLUTION = 2
+LEVEL_PAUSED = 3
+LEVEL_NAMES = {
+    LEVEL_NORMAL: "normal",
+    LEVEL_RAISED_STRIDE: "raised_stride",
+    LEVEL_REDUCED_RESOLUTION: "reduced_resolution",
+    LEVEL_PAUSED: "paused",
+}
+
+# Deepest step every priority may be degraded to
+MAX_LEVEL_FOR_PRIORITY = {
+    PRIORITY_LOW: LEVEL_PAUSED,
+    PRIORITY_NORMAL: LEVEL_REDUCED_RESOLUTION,
+    PRIORITY_CRITICAL: LEVEL_NORMAL,
+}
+
+FRAME_SIZE = (1920, 1080)
+DEGRADED_FRAME_SIZE = (960, 540)
+DEGRADED_STRIDE_MULTIPLIER = 2
+
+# Load thresholds. The load is considered too high when any of the signals crosses its threshold.
+BACKLOG_THRESHOLD = 256
+QUEUE_AGE_THRESHOLD = 1.0
+INFERENCE_LATENCY_THRESHOLD = 0.5
+# The service is restored once the load falls below this fraction of the thresholds
+RECOVERY_RATIO = 0.5
+# Minimum number of seconds between two decisions, so that every step can take effect before the next one
+DECISION_COOLDOWN = 2.0
+
+
+LOAD_PRESSURE = gauge("load_shedding_pressure", "Load of the consumer relative to the thresholds, above 1 is overloaded")
+CAMERA_LOAD_LEVEL = gauge("load_shedding_camera_level", "Degradation level of the camera", ("camera",))
+LOAD_SHEDDING_DECISIONS = counter(
+    "load_shedding_decisions_total", "Degradation and restoration steps taken", ("action", "camera", "level")
+)
+
+
+def frame_stride_for_level(level: int, frame_rate_factor: int) -> int:
+    """Returns the number of frames a camera advances per processed frame at the given level"""
+    if level >= LEVEL_RAISED_STRIDE:
+        return frame_rate_factor * DEGRADED_STRIDE_MULTIPLIER
+    return frame_rate_factor
+
+
+def frame_size_for_level(level: int) -> tuple:
+    """Returns the size the frames of a camera are resized to at the given level"""
+    if level >= LEVEL_REDUCED_RESOLUTION:
+        return DEGRADED_FRAME_SIZE
+    return FRAME_SIZE
+
+
+class LoadSheddingController:
+    """
+    A class to represent a load-shedding controller. It watches the backlog, the queue age and the inference latency of
+    a consumer, and degrades or restores the cameras one step at a time in the order of their priorities.
+    """
+
+    def __init__(self, camera_priorities: dict = None, shared_levels=None,
+                 backlog_threshold: int = BACKLOG_THRESHOLD,
+                 queue_age_threshold: float = QUEUE_AGE_THRESHOLD,
+                 inference_latency_threshold: float = INFERENCE_LATENCY_THRESHOLD):
+        """
+        Initialize the controller
+
+        Args:
+            camera_priorities (dict): priority of every camera, cameras missing here get PRIORITY_NORMAL
+            shared_levels: mapping of camera names to degradation levels that is read by the producer. Use a
+                multiprocessing.Manager().dict() when the producer runs in another process.
+            backlog_threshold (int): number of waiting frames considered too many
+            queue_age_threshold (float): age in seconds of the oldest batched frame considered too old
+            inference_latency_threshold (float): inference time in seconds per batch considered too slow
+        """
+        self.camera_priorities = CAMERA_PRIORITIES if camera_priorities is None else camera_priorities
+        self.levels = {} if shared_levels is None else shared_levels
+        self.backlog_threshold = backlog_threshold
+        self.queue_age_threshold = queue_age_threshold
+        self.inference_latency_threshold = inference_latency_threshold
+        # only the cameras seen by this consumer are managed, so that sharded consumers do not interfere
+        self.active_cameras = set()
+        self.pressure = 0.0
+        self.last_decision_time = 0.0
+        # number of decisions taken per (action, camera, level)
+        self.decision_counts = {}
+
+    def priority(self, cam_name: str) -> int:
+        """Returns the priority of the camera"""
+        return self.camera_priorities.get(cam_name, PRIORITY_NORMAL)
+
+    def level(self, cam_name: str) -> int:
+        """Returns the current degradation level of the camera"""
+        return self.levels.get(cam_name, LEVEL_NORMAL)
+
+    def observe(self, backlog: int, inference_latency: float, queue_age: float = None, cam_names=()):
+        """
+        Records the load after a batch and takes a decision if needed
+
+        Args:
+            backlog (int): number of frames waiting in the buffer
+            inference_latency (float): time in seconds taken to process the batch
+            queue_age (float): age in seconds of the oldest frame in the batch, if known
+            cam_names: names of the cameras in the batch
+
+        Returns:
+            tuple: (action, cam_name, level) of the decision taken, or None
+        """
+        self.active_cameras.update(cam_names)
+
+        pressure = max(backlog / self.backlog_threshold, inference_latency / self.inference_latency_threshold)
+        if queue_age is not None:
+            pressure = max(pressure, queue_age / self.queue_age_threshold)
+        self.pressure = pressure
+        LOAD_PRESSURE.set(pressure)
+
+        now = time.monotonic()
+        if now - self.last_decision_time < DECISION_COOLDOWN:
+            return None
+
+        if pressure > 1.0:
+            decision = self._degrade()
+        elif pressure < RECOVERY_RATIO:
+            decision = self._restore()
+        else:
+            decision = None
+
+        if decision is not None:
+            self.last_decision_time = now
+            self.decision_counts[decision] = self.decision_counts.get(decision, 0) + 1
+            action, cam_name, level = decision
+            LOAD_SHEDDING_DECISIONS.labels(action, cam_name, LEVEL_NAMES[level]).inc()
+            CAMERA_LOAD_LEVEL.labels(cam_name).set(level)
+            print(f"Load shedding: {action} {cam_name} to {LEVEL_NAMES[level]} (pressure: {pressure:.2f})")
+        return decision
+
+    def _degrade(self):
+        """Moves the lowest priority camera with the least degradation one step down"""
+        candidates = [
+            cam_name for cam_name in self.active_cameras
+            if self.level(cam_name) < MAX_LEVEL_FOR_PRIORITY[self.priority(cam_name)]
+        ]
+        if not candidates:
+            return None
+        cam_name = min(candidates, key=lambda name: (self.level(name), self.priority(name), name))
+        level = self.level(cam_name) + 1
+        self.levels[cam_name] = level
+        return "degrade", cam_name, level
+
+    def _restore(self):
+        """Moves the camera that was degraded last one step up"""
+        candidates = [cam_name for cam_name in self.active_cameras if self.level(cam_name) > LEVEL_NORMAL]
+        if not candidates:
+            return None
+        cam_name = max(candidates, key=lambda name: (self.level(name), self.priority(name), name))
+        level = self.level(cam_name) - 1
+        self.levels[cam_name] = level
+        return "restore", cam_name, level
+
+    def metrics(self) -> dict:
+        """Returns a snapshot of the state and the decisions of the controller"""
+        return {
+            "pressure": self.pressure,
+            "levels": {cam_name: self.level(cam_name) for cam_name in sorted(self.active_cameras)},
+            "decisions": dict(self.decision_counts),
+        }
@@ -0,0 +1,8 @@
+# Model files of the detection backends. The ONNX models run on the CPU through onnxruntime, see int8_calibration.py
+# for building the INT8 model. They are kept apart from count_in_line.py so that the tools can name the models without
+# the detector installed.
+MODEL_BACKENDS = {
+    "tensorrt": "yolov10x.engine",
+    "onnx-fp32": "yolov10x.onnx",
+    "onnx-int8": "yolov10x_int8.onnx",
+}
@@ -0,0 +1,126 @@
+import cv2
+import numpy
+
+# Value of the canvas pixels that no frame covers, the letterbox colour of the detector
+MOSAIC_FILL_VALUE = 114
+# A box reaching closer than this to the edge of its tile may be cut by the tile border
+MOSAIC_BORDER_MARGIN = 2
+
+
+class MosaicLayout:
+    """
+    A class to represent the layout of a mosaic canvas: a grid of tiles, each holding one downscaled camera frame. The
+    frames keep their aspect ratio and are placed at the top left corner of their tiles.
+    """
+
+    def __init__(self, rows: int, cols: int, tile_size: tuple):
+        """
+        Initialize the layout
+
+        Args:
+            rows (int): number of tile rows
+            cols (int): number of tile columns
+            tile_size (tuple): (width, height) of a tile
+        """
+        self.rows = rows
+        self.cols = cols
+        self.tile_width, self.tile_height = tile_size
+        self.canvas_size = (cols * self.tile_width, rows * self.tile_height)
+
+    @property
+    def tiles_per_canvas(self) -> int:
+        """Number of frames a canvas holds"""
+        return self.rows * self.cols
+
+    def pack(self, frames: list):
+        """
+        Downscales the frames into as few canvases as possible
+
+        Args:
+            frames (list): frames to pack
+
+        Returns:
+            tuple: the canvases, and for every canvas the placement (x, y, width, height, scale) of each of its frames
+        """
+        canvases = []
+        placements = []
+        canvas_width, canvas_height = self.canvas_size
+        for start in range(0, len(frames), self.tiles_per_canvas):
+            canvas = numpy.full((canvas_height, canvas_width, 3), MOSAIC_FILL_VALUE, dtype=numpy.uint8)
+            canvas_placements = []
+            for tile_index, frame in enumerate(frames[start:start + self.tiles_per_canvas]):
+                frame_height, frame_width = frame.shape[:2]
+                scale = min(self.tile_width / frame_width, self.tile_height / frame_height)
+                width, height = int(frame_width * scale), int(frame_height * scale)
+                x = tile_index % self.cols * self.tile_width
+                y = tile_index // self.cols * self.tile_height
+                canvas[y:y + height, x:x + width] = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+                canvas_placements.append((x, y, width, height, scale))
+            canvases.append(canvas)
+            placements.append(canvas_placements)
+        return canvases, placements
+
+    def _crosses_border(self, box: tuple, frame_rect: tuple) -> bool:
+        """
+        Returns whether a box leaves the frame it was found in, or touches an edge of the frame where the frame of the
+        next tile begins, in which case the object may continue in that tile
+        """
+        x1, y1, x2, y2 = box
+        x, y, width, height = frame_rect
+        canvas_width, canvas_height = self.canvas_size
+        if x1 < x or y1 < y or x2 > x + width or y2 > y + height:
+            return True
+        next_tile_on_right = width >= self.tile_width and x + self.tile_width < canvas_width
+        next_tile_below = height >= self.tile_height and y + self.tile_height < canvas_height
+        return (
+            (x > 0 and x1 < x + MOSAIC_BORDER_MARGIN)
+            or (y > 0 and y1 < y + MOSAIC_BORDER_MARGIN)
+            or (next_tile_on_right and x2 > x + width - MOSAIC_BORDER_MARGIN)
+            or (next_tile_below and y2 > y + height - MOSAIC_BORDER_MARGIN)
+        )
+
+    def split(self, canvas_detections: list, placements: list) -> list:
+        """
+        Assigns the detections on the canvases back to their frames, in frame coordinates. Detections that leave the
+        frame their center falls in, or touch a border it shares with the next tile, are suppressed since the object
+        may be cut by the border or span several tiles.
+
+        Args:
+            canvas_detections (list): detections (x1, y1, x2, y2, confidence, class) on every canvas
+            placements (list): placements of the frames on every canvas, as returned by `pack`
+
+        Returns:
+            list: the detections of every frame
+        """
+        frame_detections = []
+        for detections, canvas_placements in zip(canvas_detections, placements):
+            detections_per_tile = [[] for _ in canvas_placements]
+            for x1, y1, x2, y2, confidence, class_id in detections:
+                tile_index = int((y1 + y2) / 2 // self.tile_height * self.cols + (x1 + x2) / 2 // self.tile_width)
+                if tile_index >= len(canvas_placements):
+                    continue
+                x, y, width, height, scale = canvas_placements[tile_index]
+                if self._crosses_border((x1, y1, x2, y2), (x, y, width, height)):
+                    continue
+                detections_per_tile[tile_index].append(
+                    ((x1 - x) / scale, (y1 - y) / scale, (x2 - x) / scale, (y2 - y) / scale, confidence, class_id)
+                )
+            frame_detections.extend(detections_per_tile)
+        return frame_detections
+
+
+def detect_in_mosaics(detect, frames: list, layout: MosaicLayout) -> list:
+    """
+    Runs a detector once on mosaic canvases instead of on every frame
+
+    Args:
+        detect: function that takes a list of images and returns the detections (x1, y1, x2, y2, confidence, class)
+            of every image
+        frames (list): frames to detect on
+        layout (MosaicLayout): layout of the canvases
+
+    Returns:
+        list: the detections of every frame, in frame coordinates
+    """
+    canvases, placements = layout.pack(frames)
+    return layout.split(detect(canvases), placements)
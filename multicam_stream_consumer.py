@@ -1,4 +1,8 @@
+import queue
 import threading
+import time
+from pipeline_metrics import RATIO_BUCKETS, counter, gauge, histogram, start_metrics_server
+from stage_profiler import install_profiler_signal_handler
 from student_count import batched_frame_student_count
 
 
@@ -7,86 +11,161 @@ BATCH_SIZE = 16
 LIVE_STREAM_BUFFER_SIZE = 2048
 LIVE_STREAM_BUFFER_PURGE_SIZE = 64
 NUMBER_OF_THREADS = 2
+# Frames older than this many seconds are dropped before inference since their result would be too late to be useful
+MAX_FRAME_AGE = 2.0
+# Seconds the consumer waits for the next frame of a batch before it sends the frames it has, so that it never blocks
+# on an empty buffer while holding the lock and notices the stop event
+BUFFER_GET_TIMEOUT = 0.1
 
-def student_count(shared_buffer):
+# Per-camera sequence number of the last frame taken from the buffer
+last_sequence_numbers = {}
+
+QUEUE_DEPTH = gauge("consumer_queue_depth", "Frames waiting in the shared buffer after a batch")
+BATCH_ACCUMULATION_SECONDS = histogram("consumer_batch_accumulation_seconds", "Time taken to accumulate a batch")
+BATCH_FILL_RATIO = histogram(
+    "consumer_batch_fill_ratio", "Fraction of the frames taken from the buffer that were fresh enough to fill the batch",
+    buckets=RATIO_BUCKETS,
+)
+INFERENCE_SECONDS = histogram("consumer_inference_seconds", "Time taken to process a batch")
+CAPTURE_LATENCY_SECONDS = histogram(
+    "frame_capture_to_inference_seconds", "Time from the capture of a frame to the end of its inference", ("camera",)
+)
+FRAMES_PROCESSED = counter("consumer_frames_processed_total", "Frames processed by the consumer", ("camera",))
+FRAMES_DROPPED = counter("consumer_frames_dropped_total", "Frames dropped by the consumer", ("camera", "reason"))
+FRAME_SEQUENCE_GAPS = counter(
+    "consumer_frame_sequence_gaps_total", "Frames missing from the sequence of a camera when they reach the consumer",
+    ("camera",),
+)
+
+
+def _is_stale(camera_elements) -> bool:
+    """Checks the age of the frame and keeps track of the gaps in the sequence of its camera"""
+    _, cam_name, _, capture_time, sequence_number = camera_elements
+
+    last_sequence_number = last_sequence_numbers.get(cam_name)
+    if last_sequence_number is not None and sequence_number > last_sequence_number + 1:
+        FRAME_SEQUENCE_GAPS.labels(cam_name).inc(sequence_number - last_sequence_number - 1)
+    last_sequence_numbers[cam_name] = sequence_number
+
+    if time.monotonic() - capture_time > MAX_FRAME_AGE:
+        FRAMES_DROPPED.labels(cam_name, "stale").inc()
+        return True
+    return False
+
+
+def _add_frames_done(frames_done, number_of_frames: int):
+    """Adds the frames that left the buffer for good, processed or dropped, to the shared counter if there is one"""
+    if frames_done is not None:
+        with frames_done.get_lock():
+            frames_done.value += number_of_frames
+
+
+def student_count(shared_buffer, result_buffer=None, stop_event=None, load_controller=None, frames_done=None):
     """
     This function gets frames from the shared buffer and collects them in batches for face recognition.
 
     Parameters:
         shared_buffer: A shared buffer that contains frames from all the cameras
+        result_buffer: Optional buffer that receives the (cam_names, counts) of every processed batch
+        stop_event: Optional event that stops the consumer once it is set
+        load_controller: Optional LoadSheddingController that degrades the cameras when the consumer falls behind
+        frames_done: Optional shared counter of the frames taken from the buffer and processed or dropped
     """
-    while True:
+    while stop_event is None or not stop_event.is_set():
         # Apply thread lock to the shared buffer
         with lock:
-            # frame_accumulation_start_time = time.time()
-            # if the shared buffer to the corresponding camera is empty, then continue
-            if shared_buffer.qsize() < BATCH_SIZE:
-                continue
-
+            # wait on the shared buffer instead of polling its size, so that an idle consumer does not keep a core busy
+            frame_accumulation_start_time = None
+            frames_taken = 0
             batched_frame_buffer = []
             while len(batched_frame_buffer) != BATCH_SIZE:
-                camera_elements = shared_buffer.get()
+                try:
+                    camera_elements = shared_buffer.get(timeout=BUFFER_GET_TIMEOUT)
+                except queue.Empty:
+                    # the buffer ran dry, send a partial batch instead of waiting
+                    break
+                if frame_accumulation_start_time is None:
+                    frame_accumulation_start_time = time.monotonic()
+                frames_taken += 1
+                if _is_stale(camera_elements):
+                    continue
                 batched_frame_buffer.append(camera_elements)
-            # frame_accumulation_end_time = time.time()
-            # frame_accumulation_total_time = frame_accumulation_end_time - frame_accumulation_start_time
-            # print(
-            #     f"Time taken to accumulate frames for batch of size {BATCH_SIZE} is "
-            #     f"{frame_accumulation_total_time:>20.9f} seconds"
-            # )
-            # multicam_server_logger.info(
-            #     f"Time taken to accumulate frames for batch of size {BATCH_SIZE} is "
-            #     f"{frame_accumulation_total_time:>20.9f} seconds"
-            # )
+            if not frames_taken:
+                continue
+            BATCH_ACCUMULATION_SECONDS.observe(time.monotonic() - frame_accumulation_start_time)
+            BATCH_FILL_RATIO.observe(len(batched_frame_buffer) / frames_taken)
+            if not batched_frame_buffer:
+                _add_frames_done(frames_done, frames_taken)
+                continue
 
         # extract batch of frames and camera names from the batched_frame_buffer
-        # batch_extraction_start_time = time.time()
         batch_of_frames = [batch_elements[0] for batch_elements in batched_frame_buffer]
         batch_of_cam_names = [batch_elements[1] for batch_elements in batched_frame_buffer]
         batch_of_cam_ips = [batch_elements[2] for batch_elements in batched_frame_buffer]
-        # batch_extraction_end_time = time.time()
-        # batch_extraction_total_time = batch_extraction_end_time - batch_extraction_start_time
-        # multicam_server_logger.info(
-        #     f"Time taken to extract batch of size {BATCH_SIZE} is {batch_extraction_total_time:>20.9f} seconds"
-        # )
+        batch_of_capture_times = [batch_elements[3] for batch_elements in batched_frame_buffer]
 
-        # recognition_start_time = time.time()
+        inference_start_time = time.monotonic()
         # Perform batched face recognition on the frames in the buffer
-        batched_frame_student_count(
+        batch_of_counts = batched_frame_student_count(
             batch_of_frames=batch_of_frames,
             batch_of_cam_names=batch_of_cam_names,
             batch_of_cam_ips=batch_of_cam_ips,
+            batch_of_capture_times=batch_of_capture_times,
         )
-        # recognition_end_time = time.time()
-        # recognition_total_time = recognition_end_time - recognition_start_time
-        # multicam_server_logger.info(
-        #     f"Time taken to process batch of size {BATCH_SIZE} is {recognition_total_time:>20.9f} seconds"
-        # )
+        inference_end_time = time.monotonic()
+        inference_latency = inference_end_time - inference_start_time
+        INFERENCE_SECONDS.observe(inference_latency)
+        for cam_name, capture_time in zip(batch_of_cam_names, batch_of_capture_times):
+            CAPTURE_LATENCY_SECONDS.labels(cam_name).observe(inference_end_time - capture_time)
+            FRAMES_PROCESSED.labels(cam_name).inc()
+        # hand the counts over to whoever merges the results of all the consumers
+        if result_buffer is not None and batch_of_counts is not None:
+            result_buffer.put((batch_of_cam_names, batch_of_counts))
+
+        _add_frames_done(frames_done, frames_taken)
 
         # Delete batch_of_frames
         del batch_of_frames
 
         frames_buffer_size = shared_buffer.qsize()
+        QUEUE_DEPTH.set(frames_buffer_size)
+        if load_controller is not None:
+            load_controller.observe(
+                backlog=frames_buffer_size,
+                inference_latency=inference_latency,
+                queue_age=inference_start_time - min(batch_of_capture_times),
+                cam_names=batch_of_cam_names,
+            )
+        # purging random frames is the last resort when the load-shedding controller cannot keep up
         # print(f"THREAD: {thread_id} CURRENT BUFFER SIZE: {frames_buffer_size}")
         if frames_buffer_size > LIVE_STREAM_BUFFER_SIZE:
             print(f"Frames buffer size {frames_buffer_size}. Purging frames_buffer...")
             for _ in range(LIVE_STREAM_BUFFER_PURGE_SIZE):
-                shared_buffer.get()
+                purged_elements = shared_buffer.get()
+                FRAMES_DROPPED.labels(purged_elements[1], "purge").inc()
+            _add_frames_done(frames_done, LIVE_STREAM_BUFFER_PURGE_SIZE)
 
-        # consumption_end_time = time.time()
-        # total_consumption_time = consumption_end_time - consumption_start_time
-        # multicam_server_logger.info(
-        #     f"Total time taken by consumer to consume the whole batch is {total_consumption_time:>20.9f} seconds"
-        # )
-
-def consumer_main(shared_buffer):
+def consumer_main(shared_buffer, result_buffer=None, stop_event=None, load_controller=None, metrics_port=None,
+                  frames_done=None):
     """
     This function starts the face recognition process.
 
     Parameters:
         shared_buffer: A shared buffer that contains frames from all the cameras
+        result_buffer: Optional buffer that receives the counts of every processed batch
+        stop_event: Optional event that stops the consumer once it is set
+        load_controller: Optional LoadSheddingController that degrades the cameras when the consumer falls behind
+        metrics_port: Optional local port to serve the metrics of the consumer on
+        frames_done: Optional shared counter of the frames taken from the buffer and processed or dropped
     """
+    if metrics_port is not None:
+        start_metrics_server(metrics_port)
+    install_profiler_signal_handler()
     try:
-        student_count(shared_buffer)
+        student_count(
+            shared_buffer, result_buffer=result_buffer, stop_event=stop_event, load_controller=load_controller,
+            frames_done=frames_done,
+        )
 
     except KeyboardInterrupt:
         print("EXITING THE PROGRAM...")
\ No newline at end of file
@@ -2,11 +2,21 @@ import threading
 import time
 import cv2
 
+from load_shedding import LEVEL_NORMAL, LEVEL_PAUSED, frame_size_for_level, frame_stride_for_level
+from pipeline_metrics import counter, gauge, histogram, start_metrics_server
+from stage_profiler import install_profiler_signal_handler
+
 # A list of all the active cameras
 cameras = []
+# The sequence number of the last frame placed in the buffer by each camera. It is kept outside the camera objects so
+# that the numbering continues when a camera is re-initialized.
+frame_sequence_numbers = {}
 
 FRAME_RATE_FACTOR = 3
 IP_CAM_REINIT_WAIT_DURATION = 10
+# Seconds a camera keeps its degradation level before looking it up again, every lookup is a round trip to the manager
+# process holding the shared levels
+LOAD_LEVEL_REFRESH_INTERVAL = 0.5
 CAM_USERNAME = "grilsquad"
 CAM_PASSWORD = "grilsquad"
 IP_CAMS = {
@@ -14,25 +24,56 @@ IP_CAMS = {
     "cam-2": "video.mp4"
 }
 
+FRAMES_READ = counter("camera_frames_read_total", "Frames read from the camera stream, including skipped frames", ("camera",))
+FRAMES_CAPTURED = counter("camera_frames_captured_total", "Frames placed in the shared buffer", ("camera",))
+DECODE_SECONDS = histogram("camera_decode_seconds", "Time taken to read and decode a processed frame", ("camera",))
+RESIZE_SECONDS = histogram("camera_resize_seconds", "Time taken to resize a processed frame", ("camera",))
+STREAM_INIT_SECONDS = histogram("camera_stream_init_seconds", "Time taken to open a camera stream", ("camera",))
+STREAM_FAILURES = counter("camera_stream_failures_total", "Camera streams released after a failure", ("camera",))
+CAMERA_UP = gauge("camera_up", "Whether the camera stream is initialized", ("camera",))
+
+
+def open_stream(cam_ip: str):
+    """
+    Opens the video stream of a camera
+
+    Args:
+        cam_ip (str): url or ip address of the camera
+
+    Returns:
+        cv2.VideoCapture: the opened stream
+    """
+    return cv2.VideoCapture(cam_ip if cam_ip.startswith("http") else f"rtsp://{CAM_USERNAME}:{CAM_PASSWORD}@{cam_ip}:554/stream1")
+
 
 class IPCamera:
     """A class to represent an IP camera"""
 
-    def __init__(self, cam_name: str, cam_ip: str, shared_buffer):
+    def __init__(self, cam_name: str, cam_ip: str, shared_buffer, load_levels=None):
         """Initialize the camera"""
         self.frame = None
         self.shared_buffer = shared_buffer
+        # degradation levels decided by the load-shedding controller, and the level of this camera looked up last
+        self.load_levels = load_levels
+        self.load_level = LEVEL_NORMAL
+        self.load_level_refresh_time = 0.0
         self.cam_name = cam_name
         self.cam_ip = cam_ip
-        # # timestamp before capturing video stream
-        # tick = time.time()
+        # look the metrics of the camera up once so that recording them is cheap
+        self.frames_read = FRAMES_READ.labels(cam_name)
+        self.frames_captured = FRAMES_CAPTURED.labels(cam_name)
+        self.decode_seconds = DECODE_SECONDS.labels(cam_name)
+        self.resize_seconds = RESIZE_SECONDS.labels(cam_name)
+        # timestamp before capturing video stream
+        tick = time.monotonic()
         # initialize the video camera stream and read the first frame
-        self.stream = cv2.VideoCapture(cam_ip if cam_ip.startswith("http") else f"rtsp://{CAM_USERNAME}:{CAM_PASSWORD}@{cam_ip}:554/stream1")
+        self.stream = open_stream(cam_ip)
         # we need to read the first frame to initialize the stream
         # _, _ = self.stream.read()
         self.grabbed, _ = self.stream.read()
         # store whether the camera stream was initialized successfully
         self.is_initialized = self.grabbed
+        CAMERA_UP.labels(cam_name).set(1 if self.grabbed else 0)
         # set the flag to process the frame
         self.process_this_frame = True
         # initialize a frame counter
@@ -52,47 +93,71 @@ class IPCamera:
                 f"Camera stream from {self.cam_name} (url: {self.cam_ip})) unable to initialize"
             )
         else:
-            # # timestamp once the frame is grabbed successfully
-            # tock = time.time()
-            # # total time to grab and initialize the stream
-            # time_taken = tock - tick
-            # print(f"Time taken to grab and initialize the camera stream is {time_taken:>20.9f} seconds")
-            # multicam_server_logger.info(
-            #     f"Time taken to grab and initialize the camera stream is {time_taken:>20.9f} seconds"
-            # )
+            # total time to grab and initialize the stream
+            STREAM_INIT_SECONDS.labels(cam_name).observe(time.monotonic() - tick)
             print(
                 f"Camera stream from {self.cam_name} (url: {self.cam_ip}) initialized"
             )
 
     def _read_one_frame(self):
         """Reads a frame from the camera"""
+        read_start_time = time.monotonic()
         self.grabbed, self.frame = self.stream.read()
+        read_end_time = time.monotonic()
+        # monotonic time at which the frame was captured, comparable across the producer and consumer processes. A
+        # replayed recording reports the time the frame was recorded at.
+        last_capture = getattr(self.stream, "last_capture", None)
+        self.capture_time = read_end_time if last_capture is None else last_capture[0]
+        self.decode_seconds.observe(read_end_time - read_start_time)
+        self.frames_read.inc()
 
     def _read_and_discard_frame(self):
         """Reads and discards one frame"""
         _, _ = self.stream.read()
+        self.frames_read.inc()
 
     def release(self):
         """Releases the camera stream"""
         self.stream.release()
+        CAMERA_UP.labels(self.cam_name).set(0)
+
+    def _current_load_level(self) -> int:
+        """Returns the degradation level of the camera, looked up at most every LOAD_LEVEL_REFRESH_INTERVAL seconds"""
+        if self.load_levels is not None:
+            now = time.monotonic()
+            if now >= self.load_level_refresh_time:
+                self.load_level = self.load_levels.get(self.cam_name, LEVEL_NORMAL)
+                self.load_level_refresh_time = now + LOAD_LEVEL_REFRESH_INTERVAL
+        return self.load_level
 
     def place_frame_in_buffer(self):
         """Places the frame in the buffer"""
         # frame_processed = None
-        if self.process_this_frame:
+        load_level = self._current_load_level()
+        if load_level >= LEVEL_PAUSED:
+            # keep draining the stream while the camera is paused so that it resumes with fresh frames
+            self._read_and_discard_frame()
+        elif self.process_this_frame:
             self._read_one_frame()
             if not self.grabbed:
                 # if the frame was not grabbed, then we have reached the end of the stream
                 print(
                     f'Could not read a frame from the camera stream from {self.cam_name} (url: {self.cam_ip})). '
                     f'Releasing the stream...')
+                STREAM_FAILURES.labels(self.cam_name).inc()
                 self.release()
                 self.is_initialized = False
             else:
                 # resize the frame if the frame size is larger than the frame size specified in parameters.py
-                self.frame = cv2.resize(self.frame, (1920, 1080))
+                resize_start_time = time.monotonic()
+                self.frame = cv2.resize(self.frame, frame_size_for_level(load_level))
+                self.resize_seconds.observe(time.monotonic() - resize_start_time)
 
-                self.shared_buffer.put((self.frame, self.cam_name, self.cam_ip))
+                sequence_number = frame_sequence_numbers.get(self.cam_name, 0) + 1
+                frame_sequence_numbers[self.cam_name] = sequence_number
+
+                self.shared_buffer.put((self.frame, self.cam_name, self.cam_ip, self.capture_time, sequence_number))
+                self.frames_captured.inc()
 
             # # set the flag to True since the frame was processed
             # frame_processed = True
@@ -105,7 +170,7 @@ class IPCamera:
 
         # toggle the flag to process alternate frames to improve the performance
         self.frame_counter += 1
-        if self.frame_counter % FRAME_RATE_FACTOR == 0:
+        if self.frame_counter % frame_stride_for_level(load_level, FRAME_RATE_FACTOR) == 0:
             self.process_this_frame = True
         else:
             self.process_this_frame = False
@@ -114,7 +179,7 @@ class IPCamera:
         # return frame_processed
 
 
-def create_camera(cam_name: str, cam_ip: str, shared_buffer):
+def create_camera(cam_name: str, cam_ip: str, shared_buffer, load_levels=None):
     """
     Creates a camera object and places the frames in the buffer
 
@@ -122,22 +187,17 @@ def create_camera(cam_name: str, cam_ip: str, shared_buffer):
         cam_name (str): name of the camera
         cam_ip (str): url of the camera
         shared_buffer: shared memory space to store the pre-processed frames
+        load_levels: degradation levels of the cameras decided by the load-shedding controller
 
     Returns:
         None
     """
     global cameras
 
-    cam = IPCamera(cam_name, cam_ip, shared_buffer)
+    cam = IPCamera(cam_name, cam_ip, shared_buffer, load_levels)
     cameras.append(cam)
-    # Place the frames in the buffer until the end of the camera stream is reached
-
-    # # Initialize a start time and a frame counter
-    # fps_start_time = time.time()
-    # fps_frame_counter = 0
-    # batch_start_time = time.time()
-    # batch_frame_counter = 0
-
+    # Place the frames in the buffer until the end of the camera stream is reached.
+    # The frame rate of the camera is the rate of camera_frames_captured_total in the metrics.
     while True:
         if cam.is_initialized:
             # # Message to be sent
@@ -146,45 +206,16 @@ def create_camera(cam_name: str, cam_ip: str, shared_buffer):
             # cam.send_kafka_message(message)
             try:
                 cam.place_frame_in_buffer()
-                # if cam.place_frame_in_buffer():
-                #     # increment the frame counter
-                #     fps_frame_counter += 1
-                #     batch_frame_counter += 1
-                #     if batch_frame_counter == BATCH_SIZE:
-                #         batch_end_time = time.time()
-                #         batch_frame_counter = 0
-                #         batch_accumulation_time = batch_end_time - batch_start_time
-                #         print(
-                #             f"Time taken to accumulate frames of batch size {BATCH_SIZE} is "
-                #             f"{batch_accumulation_time:>20.9f} seconds"
-                #         )
-                #         multicam_server_logger.info(
-                #             f"Time taken to accumulate frames of batch size {BATCH_SIZE} is "
-                #             f"{batch_accumulation_time:>20.9f} seconds"
-                #         )
-                #         batch_start_time = time.time()
             except Exception as error:
                 # if an exception is raised, then release the camera stream and set the flag to False
                 print(
                     f'Exception raised while placing the frame in the buffer from {cam.cam_name} '
                     f'(url: {cam.cam_ip})) due to {error}. Releasing the stream...'
                 )
+                STREAM_FAILURES.labels(cam.cam_name).inc()
                 cam.release()
                 cam.is_initialized = False
         else:
-            # # calculate the end time
-            # fps_end_time = time.time()
-            # # calculate the time elapsed
-            # time_elapsed = fps_end_time - fps_start_time
-            # # calculate the frame rate
-            # frame_rate = fps_frame_counter / time_elapsed
-            # print(
-            #     f"Camera stream from {cam.cam_name} (url: {cam.cam_ip})) ended. Frame rate: {frame_rate:.4f} fps"
-            # )
-            # multicam_server_logger.info(
-            #     f"Camera stream from {cam.cam_name} (url: {cam.cam_ip})) ended. Frame rate: {frame_rate:.4f} fps"
-            # )
-
             # destroy the camera object since the camera stream was not initialized
             print(
                 f"Camera stream from {cam.cam_name} (url: {cam.cam_ip})) is not accessible. Destroying the camera "
@@ -198,13 +229,19 @@ def create_camera(cam_name: str, cam_ip: str, shared_buffer):
             time.sleep(IP_CAM_REINIT_WAIT_DURATION)
             # again try to recreate a new camera object
             print(f"Creating a new camera object for {cam_name} (url: {cam_ip}))...")
-            cam = IPCamera(cam_name, cam_ip, shared_buffer)
+            cam = IPCamera(cam_name, cam_ip, shared_buffer, load_levels)
             cameras.append(cam)
 
 
-def producer_main(shared_buffer):
+def producer_main(shared_buffer, load_levels=None, metrics_port=None):
+    # Serve the metrics of the cameras if a port is given
+    if metrics_port is not None:
+        start_metrics_server(metrics_port)
+    install_profiler_signal_handler()
     # Create a thread for each camera and start the thread
     for cam_name in IP_CAMS:
         cam_ip = IP_CAMS[cam_name]
-        cam_thread = threading.Thread(target=create_camera, args=(cam_name, cam_ip, shared_buffer))
+        cam_thread = threading.Thread(
+            target=create_camera, args=(cam_name, cam_ip, shared_buffer, load_levels), name=f"camera-{cam_name}"
+        )
         cam_thread.start()
\ No newline at end of file
@@ -0,0 +1,217 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from pipeline_metrics import METRICS_HOST, counter
+
+ROLLUP_PORT = 9200
+# Bucket sizes in seconds, and the number of buckets kept per series
+GRANULARITIES = {"minute": 60, "hour": 3600, "day": 86400}
+RETAINED_BUCKETS = {"minute": 7 * 24 * 60, "hour": 90 * 24, "day": 3 * 365}
+
+# Room and gate role of every camera. Entry gates count the objects coming in, exit gates the objects going out, and
+# cameras watching both directions count both.
+GATE_ENTRY = "entry"
+GATE_EXIT = "exit"
+GATE_BOTH = "both"
+CAMERA_ROOMS = {
+    "Camera 1": ("room-1", GATE_ENTRY),
+    "Camera 2": ("room-1", GATE_EXIT),
+    "tapo-cam-1": ("room-1", GATE_BOTH),
+}
+
+ROLLUP_EVENTS = counter("rollup_events_total", "Events added to the occupancy rollups", ("room",))
+ROLLUP_IGNORED_EVENTS = counter(
+    "rollup_ignored_events_total", "Events left out of the rollups", ("reason",)
+)
+
+
+class OccupancyRollups:
+    """
+    A class to represent incremental per-room and per-camera rollups of the crossing events in minute, hour and day
+    buckets. Every event updates a fixed number of buckets, so adding an event never rescans earlier events.
+    """
+
+    def __init__(self, camera_rooms: dict = None):
+        """Initialize the rollups"""
+        self.camera_rooms = CAMERA_ROOMS if camera_rooms is None else camera_rooms
+        # current number of people inside every room
+        self.occupancy = {}
+        # (scope, key, granularity) mapped to the buckets of the series by their start time
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, scope: str, key: str, granularity: str, timestamp: float):
+        """
+        Returns the bucket of a series the timestamp falls in, creating it if needed. A full series drops its oldest
+        bucket for a new one, so events may arrive late, e.g. from the spool of an event sink.
+
+        Returns:
+            dict: the bucket, or None if the series is full and the timestamp is older than all of its buckets
+        """
+        series = self._series.setdefault((scope, key, granularity), {})
+        bucket_start = int(timestamp // GRANULARITIES[granularity] * GRANULARITIES[granularity])
+        bucket = series.get(bucket_start)
+        if bucket is None:
+            if len(series) >= RETAINED_BUCKETS[granularity]:
+                oldest_bucket_start = min(series)
+                if bucket_start < oldest_bucket_start:
+                    return None
+                del series[oldest_bucket_start]
+            bucket = series[bucket_start] = {"in": 0, "out": 0, "occupancy_max": 0, "occupancy_last": 0}
+        return bucket
+
+    def add_event(self, event: dict):
+        """
+        Adds a crossing event to the rollups
+
+        Args:
+            event (dict): crossing event with the camera, direction and wall clock timestamp
+        """
+        room, gate = self.camera_rooms.get(event["camera"], (None, None))
+        direction = event["direction"]
+        if room is None:
+            ROLLUP_IGNORED_EVENTS.labels("unknown_camera").inc()
+            return
+        if (gate == GATE_ENTRY and direction != "in") or (gate == GATE_EXIT and direction != "out"):
+            ROLLUP_IGNORED_EVENTS.labels("wrong_direction").inc()
+            return
+
+        expired = False
+        with self._lock:
+            occupancy = self.occupancy.get(room, 0)
+            occupancy = occupancy + 1 if direction == "in" else max(0, occupancy - 1)
+            self.occupancy[room] = occupancy
+            for granularity in GRANULARITIES:
+                camera_bucket = self._bucket("camera", event["camera"], granularity, event["timestamp"])
+                if camera_bucket is not None:
+                    camera_bucket[direction] += 1
+                room_bucket = self._bucket("room", room, granularity, event["timestamp"])
+                if room_bucket is not None:
+                    room_bucket[direction] += 1
+                    room_bucket["occupancy_max"] = max(room_bucket["occupancy_max"], occupancy)
+                    room_bucket["occupancy_last"] = occupancy
+                expired = expired or camera_bucket is None or room_bucket is None
+        if expired:
+            # still counted in the occupancy, only the buckets it fell in are gone
+            ROLLUP_IGNORED_EVENTS.labels("expired").inc()
+        ROLLUP_EVENTS.labels(room).inc()
+
+    def query(self, scope: str, key: str, granularity: str, start: float, end: float) -> list:
+        """
+        Returns the buckets of a series that start within a time range
+
+        Args:
+            scope (str): "room" or "camera"
+            key (str): name of the room or the camera
+            granularity (str): "minute", "hour" or "day"
+            start (float): start of the range, in seconds since the epoch
+            end (float): end of the range, in seconds since the epoch
+
+        Returns:
+            list: the buckets in time order, each with its start time
+        """
+        bucket_size = GRANULARITIES[granularity]
+        with self._lock:
+            series = self._series.get((scope, key, granularity), {})
+            # walk the range when it is shorter than the series, otherwise the series
+            if (end - start) / bucket_size < len(series):
+                first_bucket_start = int(start // bucket_size * bucket_size)
+                bucket_starts = range(first_bucket_start, int(end) + 1, bucket_size)
+            else:
+                bucket_starts = sorted(series)
+            return [
+                dict(series[bucket_start], start=bucket_start)
+                for bucket_start in bucket_starts
+                if bucket_start in series and start - bucket_size < bucket_start <= end
+            ]
+
+    def consume(self, events_queue):
+        """Adds the batches of events arriving through a queue, e.g. from a QueueBackend, until None arrives"""
+        while True:
+            events = events_queue.get()
+            if events is None:
+                break
+            for event in events:
+                self.add_event(event)
+
+
+class RollupBackend:
+    """A class to represent an event sink backend that adds the events to rollups in the same process"""
+
+    def __init__(self, rollups: OccupancyRollups):
+        """Initialize the backend"""
+        self.rollups = rollups
+
+    def write_batch(self, events: list):
+        """Adds a batch of events to the rollups"""
+        for event in events:
+            self.rollups.add_event(event)
+
+
+def _rollup_request_handler(rollups: OccupancyRollups):
+    """Returns a request handler class that serves the rollups"""
+
+    class RollupRequestHandler(BaseHTTPRequestHandler):
+        """
+        A class to represent the handler of the rollup API:
+            /occupancy                                                            current occupancy of every room
+            /rollups?scope=room&key=room-1&granularity=minute&start=...&end=...   buckets of a series
+        """
+
+        def do_GET(self):
+            """Serves the occupancy and the rollups as JSON"""
+            url = urlparse(self.path)
+            parameters = {name: values[0] for name, values in parse_qs(url.query).items()}
+            if url.path == "/occupancy":
+                with rollups._lock:
+                    body = dict(rollups.occupancy)
+            elif url.path == "/rollups":
+                try:
+                    body = rollups.query(
+                        parameters.get("scope", "room"),
+                        parameters["key"],
+                        parameters.get("granularity", "minute"),
+                        float(parameters["start"]),
+                        float(parameters["end"]),
+                    )
+                except (KeyError, ValueError) as error:
+                    self.send_error(400, f"Invalid query: {error}")
+                    return
+            else:
+                self.send_error(404)
+                return
+            encoded_body = json.dumps(body).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(encoded_body)))
+            self.end_headers()
+            self.wfile.write(encoded_body)
+
+        def log_message(self, format, *args):
+            """Keeps the queries out of the logs"""
+            pass
+
+    return RollupRequestHandler
+
+
+def start_rollup_server(rollups: OccupancyRollups, port: int = ROLLUP_PORT,
+                        host: str = METRICS_HOST) -> ThreadingHTTPServer:
+    """
+    Starts serving the rollup API over HTTP in a background thread
+
+    Args:
+        rollups (OccupancyRollups): rollups to serve
+        port (int): local port to serve the API on
+        host (str): address to bind to, the loopback interface by default
+
+    Returns:
+        ThreadingHTTPServer: the running server
+    """
+    server = ThreadingHTTPServer((host, port), _rollup_request_handler(rollups))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name=f"rollup-server-{port}", daemon=True)
+    thread.start()
+    print(f"Serving occupancy rollups on http://{host}:{port}/rollups")
+    return server
@@ -0,0 +1,238 @@
+import argparse
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+import cv2
+
+from count_in_line import MODEL_BACKENDS, PROCESS_RESOLUTION, is_crossing_line, load_model, process_camera
+from stage_profiler import install_profiler_signal_handler
+
+# Seconds every chunk starts before its own range, for its tracker to warm up and for stitching it to the chunk before
+CHUNK_OVERLAP_SECONDS = 2.0
+# Highest distance in pixels of the processing resolution between the centers of two tracks seen as the same object
+STITCH_DISTANCE = 8
+# Overlap frames two tracks must agree on before they are stitched
+STITCH_MIN_FRAMES = 3
+
+
+def process_chunk(video_path: str, start_frame: int, end_frame: int, model_backend: str = "tensorrt") -> dict:
+    """
+    Detects and tracks the objects of a range of frames of a video, like count_in_line.process_camera does
+
+    Args:
+        video_path (str): path of the video
+        start_frame (int): first frame of the range, including the overlap with the chunk before
+        end_frame (int): frame after the last frame of the range
+        model_backend (str): detection backend, one of count_in_line.MODEL_BACKENDS
+
+    Returns:
+        dict: the processed frames mapped to the track id and center point of every tracked object
+    """
+    model = load_model(model_backend)
+    cap = cv2.VideoCapture(video_path)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+
+    observations = {}
+    for frame_index in range(start_frame, end_frame):
+        success, im0 = cap.read()
+        if not success:
+            break
+        # process_camera processes every other frame starting from the first one, so the parity is global
+        if frame_index % 2 == 1:
+            continue
+
+        im0_resized = cv2.resize(im0, PROCESS_RESOLUTION)
+        results = model.track(im0_resized, persist=True, show=False, classes=[0], verbose=False)
+
+        tracks = []
+        if results and results[0].boxes is not None and len(results[0].boxes) > 0:
+            for box in results[0].boxes:
+                if hasattr(box, 'id') and box.id is not None:
+                    x1, y1, x2, y2 = [int(coord.item()) for coord in box.xyxy[0]]
+                    tracks.append((int(box.id.item()), (int((x1 + x2) / 2), int((y1 + y2) / 2))))
+        observations[frame_index] = tracks
+
+    cap.release()
+    print(f"Chunk of frames {start_frame} to {end_frame} of {video_path} processed")
+    return observations
+
+
+def _stitch(previous_observations: dict, observations: dict, overlap_frames: range, next_track_id: int):
+    """
+    Maps the track ids of a chunk to the global track ids of the chunk before, matching the tracks that follow the same
+    path through the overlap. Tracks that match nothing get new global ids.
+
+    Returns:
+        tuple: the track ids of the chunk mapped to the global ids, and the next free global id
+    """
+    votes = {}
+    for frame_index in overlap_frames:
+        for track_id, center in observations.get(frame_index, []):
+            for global_track_id, previous_center in previous_observations.get(frame_index, []):
+                if math.dist(center, previous_center) <= STITCH_DISTANCE:
+                    votes[(track_id, global_track_id)] = votes.get((track_id, global_track_id), 0) + 1
+
+    global_ids = {}
+    for (track_id, global_track_id), vote_count in sorted(votes.items(), key=lambda item: -item[1]):
+        if vote_count >= STITCH_MIN_FRAMES and track_id not in global_ids and global_track_id not in global_ids.values():
+            global_ids[track_id] = global_track_id
+    for tracks in observations.values():
+        for track_id, _ in tracks:
+            if track_id not in global_ids:
+                global_ids[track_id] = next_track_id
+                next_track_id += 1
+    return global_ids, next_track_id
+
+
+def stitch_chunks(chunk_ranges: list, chunk_observations: list) -> list:
+    """
+    Joins the observations of the chunks into one timeline with global track ids
+
+    Args:
+        chunk_ranges (list): (overlap start, own start, end) frames of every chunk
+        chunk_observations (list): observations of every chunk, as returned by process_chunk
+
+    Returns:
+        list: the processed frames in order, each with the global track id and center point of its objects
+    """
+    timeline = []
+    previous_observations = {}
+    next_track_id = 1
+    for (overlap_start, own_start, end), observations in zip(chunk_ranges, chunk_observations):
+        global_ids, next_track_id = _stitch(
+            previous_observations, observations, range(overlap_start, own_start), next_track_id
+        )
+        global_observations = {
+            frame_index: [(global_ids[track_id], center) for track_id, center in tracks]
+            for frame_index, tracks in observations.items()
+        }
+        # the overlap belongs to the chunk before, whose tracker was warm there
+        timeline.extend(
+            (frame_index, global_observations[frame_index]) for frame_index in sorted(global_observations)
+            if own_start <= frame_index < end
+        )
+        previous_observations = global_observations
+    return timeline
+
+
+def count_timeline(timeline: list, line_coordinates: list) -> dict:
+    """
+    Counts the line crossings over a stitched timeline with the rules of count_in_line.process_camera
+
+    Args:
+        timeline (list): processed frames as returned by stitch_chunks
+        line_coordinates (list): start and end points of the counting line in the processing resolution
+
+    Returns:
+        dict: final IN, OUT and INSIDE counts, and the crossing events as (frame, track id, direction)
+    """
+    line_start, line_end = line_coordinates
+    count_in = 0
+    count_out = 0
+    actual_count_out = 0
+    people_inside = 0
+    last_positions = {}
+    events = []
+    for frame_index, tracks in timeline:
+        for track_id, center in tracks:
+            if track_id in last_positions:
+                last_position = last_positions[track_id]
+                if is_crossing_line(last_position, center, line_start, line_end):
+                    if last_position[0] < center[0]:
+                        events.append((frame_index, track_id, "out"))
+                        actual_count_out += 1
+                        if people_inside > 0:
+                            count_out += 1
+                    else:
+                        events.append((frame_index, track_id, "in"))
+                        count_in += 1
+            last_positions[track_id] = center
+        people_inside = max(0, count_in - count_out)
+    return {"IN": count_in, "OUT": actual_count_out, "INSIDE": people_inside, "events": events}
+
+
+def process_video_chunked(video_path: str, line_coordinates: list, workers: int = None,
+                          overlap_seconds: float = CHUNK_OVERLAP_SECONDS, model_backend: str = "tensorrt") -> dict:
+    """
+    Counts the line crossings of a recorded video by processing time chunks of it in parallel worker processes
+
+    Args:
+        video_path (str): path of the video
+        line_coordinates (list): start and end points of the counting line in the processing resolution
+        workers (int): number of worker processes and chunks, the number of cores by default
+        overlap_seconds (float): seconds every chunk starts before its own range
+        model_backend (str): detection backend, one of count_in_line.MODEL_BACKENDS
+
+    Returns:
+        dict: final IN, OUT and INSIDE counts, and the crossing events as (frame, track id, direction)
+    """
+    workers = workers or os.cpu_count()
+    cap = cv2.VideoCapture(video_path)
+    assert cap.isOpened(), f"Error opening video {video_path}"
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    overlap_frames = int(overlap_seconds * (cap.get(cv2.CAP_PROP_FPS) or 25))
+    cap.release()
+    if frame_count <= 0:
+        raise ValueError(
+            f"The number of frames of {video_path} is unknown, so it cannot be split into chunks. Streams and some "
+            f"containers do not report it, process them with count_in_line.py instead."
+        )
+
+    chunk_length = math.ceil(frame_count / workers)
+    chunk_ranges = [
+        (max(0, own_start - overlap_frames), own_start, min(frame_count, own_start + chunk_length))
+        for own_start in range(0, frame_count, chunk_length)
+    ]
+    with multiprocessing.Pool(workers) as pool:
+        chunk_observations = pool.starmap(
+            process_chunk,
+            [(video_path, overlap_start, end, model_backend) for overlap_start, _, end in chunk_ranges],
+        )
+    return count_timeline(stitch_chunks(chunk_ranges, chunk_observations), line_coordinates)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Count the line crossings of a recorded video in parallel chunks")
+    parser.add_argument("video")
+    parser.add_argument("--line", required=True, help="counting line as x1,y1,x2,y2 in the processing resolution")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--overlap-seconds", type=float, default=CHUNK_OVERLAP_SECONDS)
+    parser.add_argument("--model-backend", default="tensorrt", choices=sorted(MODEL_BACKENDS))
+    parser.add_argument("--verify", action="store_true", help="check the counts against a sequential run")
+    args = parser.parse_args()
+    # the worker processes inherit the handler, so that profiling the process group does not kill them
+    install_profiler_signal_handler()
+
+    x1, y1, x2, y2 = (int(coordinate) for coordinate in args.line.split(","))
+    line_coordinates = [(x1, y1), (x2, y2)]
+
+    start_time = time.monotonic()
+    counts = process_video_chunked(args.video, line_coordinates, args.workers, args.overlap_seconds, args.model_backend)
+    chunked_seconds = time.monotonic() - start_time
+    print(f"Chunked: IN {counts['IN']}, OUT {counts['OUT']}, INSIDE {counts['INSIDE']} "
+          f"in {chunked_seconds:.1f} s with {args.workers} workers on {os.cpu_count()} cores")
+    if not args.verify:
+        return
+
+    start_time = time.monotonic()
+    sequential_counts = process_camera(
+        os.path.basename(args.video), args.video, None, line_coordinates, record_mode="off",
+        model_backend=args.model_backend,
+    )
+    sequential_seconds = time.monotonic() - start_time
+    speedup = sequential_seconds / chunked_seconds
+    print(f"Sequential: IN {sequential_counts['IN']}, OUT {sequential_counts['OUT']}, "
+          f"INSIDE {sequential_counts['INSIDE']} in {sequential_seconds:.1f} s")
+    print(f"Speedup {speedup:.2f}x with {args.workers} workers ({speedup / args.workers:.0%} of linear)")
+
+    if {key: counts[key] for key in ("IN", "OUT", "INSIDE")} != sequential_counts:
+        print("Chunked counts do not match the sequential run")
+        sys.exit(1)
+    print("Chunked counts match the sequential run")
+
+
+if __name__ == "__main__":
+    main()
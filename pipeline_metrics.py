@@ -0,0 +1,244 @@
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from stage_profiler import PROFILE_DURATION, start_profiling
+
+# Upper bounds in seconds of the latency buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the ratio buckets
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+
+# Every process serves its own metrics, so processes started together use consecutive ports from this one
+METRICS_PORT = 9100
+METRICS_HOST = "127.0.0.1"
+
+
+class CounterValue:
+    """A class to represent a value that only goes up"""
+
+    def __init__(self):
+        """Initialize the counter"""
+        self.value = 0
+
+    def inc(self, amount=1):
+        """Increments the counter"""
+        self.value += amount
+
+
+class GaugeValue:
+    """A class to represent a value that can go up and down"""
+
+    def __init__(self):
+        """Initialize the gauge"""
+        self.value = 0
+
+    def set(self, value):
+        """Sets the gauge to the value"""
+        self.value = value
+
+    def inc(self, amount=1):
+        """Increments the gauge"""
+        self.value += amount
+
+    def dec(self, amount=1):
+        """Decrements the gauge"""
+        self.value -= amount
+
+
+class Histogram:
+    """A class to represent a histogram of observations with fixed bucket upper bounds"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        """Initialize the histogram"""
+        self.buckets = tuple(buckets)
+        # the last count holds the observations above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """Records one observation"""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns an estimate of a quantile of the observations
+
+        Args:
+            q (float): quantile between 0 and 1
+
+        Returns:
+            float: upper bound of the bucket the quantile falls in, or infinity if it is above the largest bucket
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative_count = 0
+        for upper_bound, count in zip(self.buckets, self.counts):
+            cumulative_count += count
+            if cumulative_count >= rank:
+                return upper_bound
+        return float("inf")
+
+
+class MetricFamily:
+    """
+    A class to represent a named metric with an optional set of labels. Every combination of label values has its own
+    value object, which is created once and cached. The hot paths should look the value up once with `labels` and keep
+    the returned object, so that recording is a single attribute update without locks or allocations.
+    """
+
+    def __init__(self, name: str, documentation: str, metric_type: str, labelnames=(), value_factory=CounterValue):
+        """Initialize the metric family"""
+        self.name = name
+        self.documentation = documentation
+        self.metric_type = metric_type
+        self.labelnames = tuple(labelnames)
+        self.value_factory = value_factory
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._values[()] = value_factory()
+
+    def labels(self, *labelvalues):
+        """Returns the value object of the given label values"""
+        value = self._values.get(labelvalues)
+        if value is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f"Metric {self.name} expects the labels {self.labelnames}, got {labelvalues}")
+            with self._lock:
+                value = self._values.setdefault(labelvalues, self.value_factory())
+        return value
+
+    def __getattr__(self, attribute):
+        """Forwards inc/set/observe of metrics without labels to their single value object"""
+        if attribute.startswith("_") or self.labelnames:
+            raise AttributeError(attribute)
+        return getattr(self._values[()], attribute)
+
+    def items(self):
+        """Returns the label values and value objects of the metric"""
+        return list(self._values.items())
+
+
+class MetricsRegistry:
+    """A class to represent the collection of all the metrics of a process"""
+
+    def __init__(self):
+        """Initialize the registry"""
+        self._families = {}
+        self._lock = threading.Lock()
+
+    def register(self, family: MetricFamily) -> MetricFamily:
+        """Registers a metric family, or returns the one already registered under its name"""
+        with self._lock:
+            return self._families.setdefault(family.name, family)
+
+    def render(self) -> str:
+        """Returns all the metrics in the Prometheus text exposition format"""
+        lines = []
+        for family in list(self._families.values()):
+            lines.append(f"# HELP {family.name} {family.documentation}")
+            lines.append(f"# TYPE {family.name} {family.metric_type}")
+            for labelvalues, value in family.items():
+                labels = list(zip(family.labelnames, labelvalues))
+                if family.metric_type == "histogram":
+                    cumulative_count = 0
+                    for upper_bound, count in zip(value.buckets, value.counts):
+                        cumulative_count += count
+                        lines.append(
+                            f"{family.name}_bucket{_format_labels(labels + [('le', upper_bound)])} {cumulative_count}"
+                        )
+                    lines.append(f"{family.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {value.count}")
+                    lines.append(f"{family.name}_sum{_format_labels(labels)} {value.sum}")
+                    lines.append(f"{family.name}_count{_format_labels(labels)} {value.count}")
+                else:
+                    lines.append(f"{family.name}{_format_labels(labels)} {value.value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels) -> str:
+    """Formats the label pairs of a sample"""
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+REGISTRY = MetricsRegistry()
+
+
+def counter(name: str, documentation: str, labelnames=()) -> MetricFamily:
+    """Creates and registers a counter"""
+    return REGISTRY.register(MetricFamily(name, documentation, "counter", labelnames, CounterValue))
+
+
+def gauge(name: str, documentation: str, labelnames=()) -> MetricFamily:
+    """Creates and registers a gauge"""
+    return REGISTRY.register(MetricFamily(name, documentation, "gauge", labelnames, GaugeValue))
+
+
+def histogram(name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS) -> MetricFamily:
+    """Creates and registers a histogram"""
+    return REGISTRY.register(
+        MetricFamily(name, documentation, "histogram", labelnames, lambda: Histogram(buckets))
+    )
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """A class to represent the handler that serves the metrics of the process"""
+
+    def do_GET(self):
+        """Serves the metrics at /metrics and starts profiling the process at /profile?seconds=N"""
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            body = REGISTRY.render().encode("utf-8")
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif url.path == "/profile":
+            try:
+                duration = float(parse_qs(url.query).get("seconds", [PROFILE_DURATION])[0])
+            except ValueError:
+                self.send_error(400, "seconds must be a number")
+                return
+            output_path = start_profiling(duration)
+            message = "already profiling" if output_path is None else f"profiling to {output_path}"
+            body = f"{message}\n".encode("utf-8")
+            content_type = "text/plain; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Keeps the scrapes out of the logs"""
+        pass
+
+
+def start_metrics_server(port: int = METRICS_PORT, host: str = METRICS_HOST) -> ThreadingHTTPServer:
+    """
+    Starts serving the metrics of the process over HTTP in a background thread
+
+    Args:
+        port (int): local port to serve the metrics on
+        host (str): address to bind to, the loopback interface by default
+
+    Returns:
+        ThreadingHTTPServer: the running server
+    """
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name=f"metrics-server-{port}", daemon=True)
+    thread.start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
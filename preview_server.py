@@ -0,0 +1,175 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+import cv2
+
+from pipeline_metrics import METRICS_HOST, counter, gauge
+
+PREVIEW_PORT = 9300
+# Highest frame rate streamed to a single client
+PREVIEW_MAX_FPS = 5
+PREVIEW_JPEG_QUALITY = 80
+PREVIEW_BOUNDARY = "frame"
+
+PREVIEW_CLIENTS = gauge("preview_clients", "Clients watching a preview stream")
+PREVIEW_FRAMES_ENCODED = counter("preview_frames_encoded_total", "Preview frames annotated and encoded", ("camera",))
+
+
+class CameraPreview:
+    """
+    A class to represent the latest frame of every camera for the preview over HTTP. Publishing only keeps a reference
+    to the frame and its annotation. The annotation and the JPEG encoding are done by the HTTP threads when a client
+    asks for the frame, once per frame however many clients watch it.
+    """
+
+    def __init__(self, max_fps: float = PREVIEW_MAX_FPS, jpeg_quality: int = PREVIEW_JPEG_QUALITY):
+        """Initialize the preview"""
+        self.max_fps = max_fps
+        self.jpeg_quality = jpeg_quality
+        # camera mapped to (frame number, frame, annotate) of its latest frame
+        self._frames = {}
+        # camera mapped to (frame number, JPEG) of its latest encoded frame
+        self._encoded = {}
+        self._new_frame = threading.Condition()
+        self._encode_lock = threading.Lock()
+
+    def publish(self, camera_id, frame, annotate=None):
+        """
+        Makes a frame the latest frame of a camera. The frame is kept by reference and must not be modified afterwards.
+
+        Args:
+            camera_id: name of the camera
+            frame (numpy.ndarray): the frame
+            annotate: optional function that draws on a copy of the frame, only called when the frame is watched
+        """
+        with self._new_frame:
+            frame_number = self._frames[camera_id][0] + 1 if camera_id in self._frames else 1
+            self._frames[camera_id] = (frame_number, frame, annotate)
+            self._new_frame.notify_all()
+
+    def cameras(self) -> list:
+        """Returns the cameras that published a frame"""
+        with self._new_frame:
+            return list(self._frames)
+
+    def wait_for_frame(self, camera_id, after_frame_number: int, timeout: float) -> bool:
+        """Waits until a camera publishes a frame newer than the given one, and returns whether it did"""
+        with self._new_frame:
+            return self._new_frame.wait_for(
+                lambda: camera_id in self._frames and self._frames[camera_id][0] > after_frame_number, timeout
+            )
+
+    def jpeg(self, camera_id):
+        """
+        Returns the latest frame of a camera as a JPEG, annotating and encoding it unless it was already encoded
+
+        Args:
+            camera_id: name of the camera
+
+        Returns:
+            tuple: the frame number and the JPEG bytes, or None if the camera has not published a frame
+        """
+        with self._new_frame:
+            latest_frame = self._frames.get(camera_id)
+        if latest_frame is None:
+            return None
+        frame_number, frame, annotate = latest_frame
+        with self._encode_lock:
+            encoded = self._encoded.get(camera_id)
+            if encoded is None or encoded[0] != frame_number:
+                image = frame if annotate is None else annotate(frame.copy())
+                _, jpeg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+                encoded = self._encoded[camera_id] = (frame_number, jpeg.tobytes())
+                PREVIEW_FRAMES_ENCODED.labels(camera_id).inc()
+        return encoded
+
+
+def _preview_request_handler(preview: CameraPreview):
+    """Returns a request handler class that serves the preview"""
+
+    class PreviewRequestHandler(BaseHTTPRequestHandler):
+        """
+        A class to represent the handler of the preview:
+            /                       cameras with a preview
+            /snapshot/<camera>      latest frame of a camera as a JPEG
+            /stream/<camera>        MJPEG stream of a camera
+        """
+
+        def do_GET(self):
+            """Serves the camera list, a snapshot or a stream"""
+            path = urlparse(self.path).path
+            if path == "/":
+                body = "".join(f"{camera_id}\n" for camera_id in preview.cameras()).encode("utf-8")
+                self._send(body, "text/plain; charset=utf-8")
+            elif path.startswith("/snapshot/"):
+                encoded = preview.jpeg(unquote(path[len("/snapshot/"):]))
+                if encoded is None:
+                    self.send_error(404, "No frame from this camera")
+                    return
+                self._send(encoded[1], "image/jpeg")
+            elif path.startswith("/stream/"):
+                self._stream(unquote(path[len("/stream/"):]))
+            else:
+                self.send_error(404)
+
+        def _send(self, body: bytes, content_type: str):
+            """Sends a complete response"""
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _stream(self, camera_id):
+            """Streams the new frames of a camera, at most max_fps of them per second, until the client leaves"""
+            self.send_response(200)
+            self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={PREVIEW_BOUNDARY}")
+            self.end_headers()
+            PREVIEW_CLIENTS.inc()
+            frame_number = 0
+            try:
+                while True:
+                    sent_time = time.monotonic()
+                    if not preview.wait_for_frame(camera_id, frame_number, timeout=1.0):
+                        continue
+                    frame_number, jpeg = preview.jpeg(camera_id)
+                    self.wfile.write(
+                        f"--{PREVIEW_BOUNDARY}\r\nContent-Type: image/jpeg\r\n"
+                        f"Content-Length: {len(jpeg)}\r\n\r\n".encode("utf-8") + jpeg + b"\r\n"
+                    )
+                    delay = sent_time + 1 / preview.max_fps - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                PREVIEW_CLIENTS.dec()
+
+        def log_message(self, format, *args):
+            """Keeps the requests out of the logs"""
+            pass
+
+    return PreviewRequestHandler
+
+
+def start_preview_server(preview: CameraPreview, port: int = PREVIEW_PORT,
+                         host: str = METRICS_HOST) -> ThreadingHTTPServer:
+    """
+    Starts serving the preview over HTTP in a background thread
+
+    Args:
+        preview (CameraPreview): preview to serve
+        port (int): local port to serve the preview on
+        host (str): address to bind to, the loopback interface by default
+
+    Returns:
+        ThreadingHTTPServer: the running server
+    """
+    server = ThreadingHTTPServer((host, port), _preview_request_handler(preview))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name=f"preview-server-{port}", daemon=True)
+    thread.start()
+    print(f"Serving camera previews on http://{host}:{port}/")
+    return server
@@ -0,0 +1,361 @@
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from multiprocessing.managers import SyncManager
+
+import cv2
+
+import multistream_cam_producer
+from clip_recorder import RECORD_MODE_OFF
+from stage_profiler import ignore_profile_signal, install_profiler_signal_handler
+
+RECORDING_FOURCC = "mp4v"
+RECORDING_METADATA_FILE = "metadata.json"
+GOLDEN_FILE = "golden.json"
+
+
+def video_path(recording_dir: str, cam_name: str) -> str:
+    """Returns the path of the video of a recorded camera"""
+    return os.path.join(recording_dir, f"{cam_name}.mp4")
+
+
+def _frames_path(recording_dir: str, cam_name: str) -> str:
+    """Returns the path of the per-frame timestamps of a recorded camera"""
+    return os.path.join(recording_dir, f"{cam_name}.frames.jsonl")
+
+
+def record_camera(cam_name: str, source: str, recording_dir: str, duration: float) -> dict:
+    """
+    Records a camera stream together with the capture time and sequence number of every frame
+
+    Args:
+        cam_name (str): name of the camera
+        source (str): video file, stream URL or camera index to record
+        recording_dir (str): directory the recording is written to
+        duration (float): number of seconds to record for
+
+    Returns:
+        dict: metadata of the recorded camera
+    """
+    stream = cv2.VideoCapture(source)
+    assert stream.isOpened(), f"Error opening video source {source}"
+    width, height = int(stream.get(cv2.CAP_PROP_FRAME_WIDTH)), int(stream.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = stream.get(cv2.CAP_PROP_FPS) or 25
+
+    video_writer = cv2.VideoWriter(
+        video_path(recording_dir, cam_name), cv2.VideoWriter_fourcc(*RECORDING_FOURCC), fps, (width, height)
+    )
+    sequence_number = 0
+    started_at = time.time()
+    end_time = time.monotonic() + duration
+    with open(_frames_path(recording_dir, cam_name), "w") as frames_file:
+        while time.monotonic() < end_time:
+            grabbed, frame = stream.read()
+            capture_time = time.monotonic()
+            if not grabbed:
+                print(f"Camera stream from {cam_name} (url: {source}) ended. Stopping the recording...")
+                break
+            sequence_number += 1
+            video_writer.write(frame)
+            frames_file.write(json.dumps({
+                "sequence_number": sequence_number,
+                "capture_time": capture_time,
+                "wall_time": time.time(),
+            }) + "\n")
+
+    stream.release()
+    video_writer.release()
+    print(f"Recorded {sequence_number} frames from {cam_name}")
+    return {
+        "source": source, "fps": fps, "width": width, "height": height, "frames": sequence_number,
+        "started_at": started_at,
+    }
+
+
+def record(cameras: dict, recording_dir: str, duration: float):
+    """
+    Records several cameras at the same time
+
+    Args:
+        cameras (dict): names of the cameras mapped to their sources
+        recording_dir (str): directory the recording is written to
+        duration (float): number of seconds to record for
+    """
+    os.makedirs(recording_dir, exist_ok=True)
+    metadata = {}
+
+    def record_into_metadata(cam_name, source):
+        metadata[cam_name] = record_camera(cam_name, source, recording_dir, duration)
+
+    threads = [
+        threading.Thread(target=record_into_metadata, args=(cam_name, source), name=f"recorder-{cam_name}")
+        for cam_name, source in cameras.items()
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    with open(os.path.join(recording_dir, RECORDING_METADATA_FILE), "w") as metadata_file:
+        json.dump(metadata, metadata_file, indent=4)
+
+
+class ReplayStream:
+    """
+    A class to represent a recorded camera stream with the interface of cv2.VideoCapture. It either paces the frames
+    at their recorded capture times or returns them as fast as they can be decoded. `last_capture` holds the monotonic
+    and wall-clock capture times of the frame read last, which the counting scripts use in place of the time they read
+    it at. At the recorded rate the monotonic times are the recorded ones moved to the start of the replay, as fast as
+    possible they are the read times, since the recorded ones would lie ahead of the clock.
+    """
+
+    def __init__(self, recording_dir: str, cam_name: str, realtime: bool = True):
+        """Initialize the stream"""
+        self.stream = cv2.VideoCapture(video_path(recording_dir, cam_name))
+        with open(_frames_path(recording_dir, cam_name)) as frames_file:
+            recorded_frames = [json.loads(line) for line in frames_file]
+        self.capture_times = [recorded_frame["capture_time"] for recorded_frame in recorded_frames]
+        self.wall_times = [recorded_frame["wall_time"] for recorded_frame in recorded_frames]
+        self.realtime = realtime
+        self.frame_index = 0
+        self.replay_start_time = None
+        self.last_capture = None
+
+    def read(self):
+        """Returns the next recorded frame, once it is due when replaying at the recorded rate"""
+        grabbed, frame = self.stream.read()
+        if grabbed and self.frame_index < len(self.capture_times):
+            capture_time = time.monotonic()
+            if self.realtime:
+                if self.replay_start_time is None:
+                    self.replay_start_time = capture_time
+                capture_time = self.replay_start_time + self.capture_times[self.frame_index] - self.capture_times[0]
+                delay = capture_time - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            self.last_capture = (capture_time, self.wall_times[self.frame_index])
+        self.frame_index += 1
+        return grabbed, frame
+
+    def isOpened(self):
+        """Returns whether the recording is open"""
+        return self.stream.isOpened()
+
+    def get(self, prop_id):
+        """Returns a property of the recorded video"""
+        return self.stream.get(prop_id)
+
+    def release(self):
+        """Closes the recording"""
+        self.stream.release()
+
+
+def replay_producer_main(shared_buffer, recording_dir: str, realtime: bool = True):
+    """
+    Feeds a recording into the producer/consumer pipeline in place of the live cameras
+
+    Args:
+        shared_buffer: shared buffer the frames are placed in
+        recording_dir (str): directory of the recording
+        realtime (bool): whether to replay at the recorded rate instead of as fast as possible
+    """
+    with open(os.path.join(recording_dir, RECORDING_METADATA_FILE)) as metadata_file:
+        metadata = json.load(metadata_file)
+    # the recorded cameras are opened by name, so every camera keeps its name in the pipeline
+    multistream_cam_producer.IP_CAMS = {cam_name: cam_name for cam_name in metadata}
+    multistream_cam_producer.open_stream = lambda cam_name: ReplayStream(recording_dir, cam_name, realtime)
+    multistream_cam_producer.producer_main(shared_buffer)
+
+
+def replay_count_in_line(recording_dir: str, lines: dict, realtime: bool = False, roi_mode: bool = False,
+                         model_backend: str = "tensorrt") -> dict:
+    """
+    Runs the count_in_line counting over every recorded camera, one camera after the other
+
+    Args:
+        recording_dir (str): directory of the recording
+        lines (dict): names of the cameras mapped to their counting lines
+        realtime (bool): whether to replay at the recorded rate instead of as fast as possible
+        roi_mode (bool): whether to detect only in a band around the counting lines
+        model_backend (str): detection backend, one of count_in_line.MODEL_BACKENDS
+
+    Returns:
+        dict: names of the cameras mapped to their counts and processing throughput
+    """
+    # imported here, like entry-exit, so that the helpers of this module can be used without the detector installed
+    import count_in_line
+
+    with open(os.path.join(recording_dir, RECORDING_METADATA_FILE)) as metadata_file:
+        metadata = json.load(metadata_file)
+    count_in_line.open_capture = lambda cam_name: ReplayStream(recording_dir, cam_name, realtime)
+
+    results = {}
+    for cam_name, line_coordinates in lines.items():
+        start_time = time.monotonic()
+        # nothing is recorded, encoding the annotated stream would count against the processing throughput
+        counts = count_in_line.process_camera(
+            cam_name, cam_name, None, [tuple(point) for point in line_coordinates], record_mode=RECORD_MODE_OFF,
+            roi_mode=roi_mode, model_backend=model_backend,
+        )
+        elapsed_time = time.monotonic() - start_time
+        results[cam_name] = {"counts": counts, "frames_per_second": metadata[cam_name]["frames"] / elapsed_time}
+    return results
+
+
+def replay_entry_exit(recording_dir: str, gates: dict, realtime: bool = False) -> dict:
+    """
+    Runs the entry-exit counting over the recorded gate cameras. At the recorded rate the gates run in parallel
+    processes like a live run. As fast as possible they run one after the other so that the result is deterministic,
+    which can differ from a live run only when an exit is seen before the matching entry.
+
+    Args:
+        recording_dir (str): directory of the recording
+        gates (dict): names of the cameras mapped to their (line_y, is_entry_gate)
+        realtime (bool): whether to replay at the recorded rate instead of as fast as possible
+
+    Returns:
+        dict: the final INSIDE count
+    """
+    entry_exit = importlib.import_module("entry-exit")
+    entry_exit.open_capture = lambda cam_name: ReplayStream(recording_dir, cam_name, realtime)
+
+    manager = SyncManager()
+    manager.start(ignore_profile_signal)
+    with manager:
+        people_inside = manager.Value('i', 0)
+        arguments = [
+            (cam_name, cam_name, line_y, None, people_inside, is_entry_gate)
+            for cam_name, (line_y, is_entry_gate) in gates.items()
+        ]
+        replay_options = {"record_mode": RECORD_MODE_OFF}
+        if realtime:
+            processes = [
+                multiprocessing.Process(target=entry_exit.process_camera, args=args, kwargs=replay_options)
+                for args in arguments
+            ]
+            for process in processes:
+                process.start()
+            for process in processes:
+                process.join()
+        else:
+            # entry gates first, so that the exits are never clamped at zero
+            for args in sorted(arguments, key=lambda args: not args[5]):
+                entry_exit.process_camera(*args, **replay_options)
+        return {"INSIDE": people_inside.value}
+
+
+def _parse_assignment(value: str):
+    """Parses a camera assignment of the form name=value"""
+    cam_name, _, assigned_value = value.partition("=")
+    return cam_name, assigned_value
+
+
+def load_golden(recording_dir: str) -> dict:
+    """
+    Loads the golden counts of a recording
+
+    Args:
+        recording_dir (str): directory of the recording
+
+    Returns:
+        dict: the golden counts, empty if the recording has none
+    """
+    golden_path = os.path.join(recording_dir, GOLDEN_FILE)
+    if not os.path.exists(golden_path):
+        return {}
+    with open(golden_path) as golden_file:
+        return json.load(golden_file)
+
+
+def counting_lines(golden: dict, line_arguments: list) -> dict:
+    """
+    Returns the count_in_line counting lines of the golden counts, unless given on the command line
+
+    Args:
+        golden (dict): golden counts of the recording
+        line_arguments (list): counting lines given on the command line as name=x1,y1,x2,y2
+
+    Returns:
+        dict: names of the cameras mapped to their counting lines
+    """
+    lines = {cam_name: golden_value["line"] for cam_name, golden_value in golden.get("count_in_line", {}).items()}
+    for line in line_arguments:
+        cam_name, coordinates = _parse_assignment(line)
+        x1, y1, x2, y2 = (int(coordinate) for coordinate in coordinates.split(","))
+        lines[cam_name] = [[x1, y1], [x2, y2]]
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record camera streams and replay them against golden counts")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = subparsers.add_parser("record", help="record camera streams")
+    record_parser.add_argument("recording_dir")
+    record_parser.add_argument("cameras", nargs="+", help="cameras to record as name=source")
+    record_parser.add_argument("--duration", type=float, default=60, help="seconds to record for")
+
+    replay_parser = subparsers.add_parser("replay", help="replay a recording and check the counts")
+    replay_parser.add_argument("recording_dir")
+    replay_parser.add_argument("--line", action="append", default=[], help="count_in_line camera as name=x1,y1,x2,y2")
+    replay_parser.add_argument("--gate", action="append", default=[], help="entry-exit camera as name=line_y,entry|exit")
+    replay_parser.add_argument("--realtime", action="store_true", help="replay at the recorded rate")
+    replay_parser.add_argument("--update-golden", action="store_true", help="store the counts as the golden values")
+    args = parser.parse_args()
+    install_profiler_signal_handler()
+
+    if args.command == "record":
+        record(dict(_parse_assignment(camera) for camera in args.cameras), args.recording_dir, args.duration)
+        return
+
+    golden_path = os.path.join(args.recording_dir, GOLDEN_FILE)
+    golden = load_golden(args.recording_dir)
+
+    lines = counting_lines(golden, args.line)
+    gates = {cam_name: tuple(gate) for cam_name, gate in golden.get("entry_exit", {}).get("gates", {}).items()}
+    for gate in args.gate:
+        cam_name, gate_value = _parse_assignment(gate)
+        line_y, gate_type = gate_value.split(",")
+        gates[cam_name] = (int(line_y), gate_type == "entry")
+
+    results = {}
+    if lines:
+        line_results = replay_count_in_line(args.recording_dir, lines, args.realtime)
+        results["count_in_line"] = {
+            cam_name: {"line": lines[cam_name], "counts": result["counts"]} for cam_name, result in line_results.items()
+        }
+        for cam_name, result in line_results.items():
+            print(f"{cam_name}: {result['counts']} at {result['frames_per_second']:.1f} frames/sec")
+    if gates:
+        results["entry_exit"] = {"gates": gates, "counts": replay_entry_exit(args.recording_dir, gates, args.realtime)}
+        print(f"entry-exit: {results['entry_exit']['counts']}")
+
+    if args.update_golden:
+        with open(golden_path, "w") as golden_file:
+            json.dump(results, golden_file, indent=4)
+        print(f"Golden counts written to {golden_path}")
+        return
+
+    mismatches = []
+    for cam_name, result in results.get("count_in_line", {}).items():
+        expected = golden.get("count_in_line", {}).get(cam_name, {}).get("counts")
+        if result["counts"] != expected:
+            mismatches.append(f"{cam_name}: expected {expected}, got {result['counts']}")
+    if "entry_exit" in results:
+        expected = golden.get("entry_exit", {}).get("counts")
+        if results["entry_exit"]["counts"] != expected:
+            mismatches.append(f"entry-exit: expected {expected}, got {results['entry_exit']['counts']}")
+
+    if mismatches:
+        print("Counts do not match the golden values:\n" + "\n".join(mismatches))
+        sys.exit(1)
+    print("Counts match the golden values")
+
+
+if __name__ == "__main__":
+    main()
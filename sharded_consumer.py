@@ -0,0 +1,279 @@
+import bisect
+import hashlib
+import multiprocessing
+import threading
+from multiprocessing.managers import SyncManager
+
+from load_shedding import LoadSheddingController
+from multicam_stream_consumer import consumer_main
+from multistream_cam_producer import IP_CAMS, producer_main
+from pipeline_metrics import METRICS_PORT
+from stage_profiler import ignore_profile_signal, install_profiler_signal_handler
+
+# a shard without cameras would only sit idle
+NUMBER_OF_CONSUMER_SHARDS = min(multiprocessing.cpu_count(), len(IP_CAMS))
+VIRTUAL_NODES_PER_SHARD = 64
+SHARD_STOP_TIMEOUT = 10
+
+
+def _hash_key(key: str) -> int:
+    """Maps a key to a position on the hash ring"""
+    return int(hashlib.md5(key.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class ConsistentHashRing:
+    """A class to represent a consistent hash ring that assigns cameras to consumer shards"""
+
+    def __init__(self, shard_ids=(), virtual_nodes: int = VIRTUAL_NODES_PER_SHARD):
+        """Initialize the ring with the given shards"""
+        self.virtual_nodes = virtual_nodes
+        # sorted positions of all the virtual nodes and the shard owning each of them. They are replaced together in a
+        # single assignment, so that a concurrent lookup always sees positions and owners that belong together.
+        self._ring = ((), {})
+        for shard_id in shard_ids:
+            self.add_shard(shard_id)
+
+    def add_shard(self, shard_id: int):
+        """Places the virtual nodes of a shard on the ring"""
+        positions, owners = self._ring
+        positions, owners = list(positions), dict(owners)
+        for replica in range(self.virtual_nodes):
+            position = _hash_key(f"shard-{shard_id}#{replica}")
+            if position in owners:
+                continue
+            owners[position] = shard_id
+            bisect.insort(positions, position)
+        self._ring = (tuple(positions), owners)
+
+    def remove_shard(self, shard_id: int):
+        """Removes the virtual nodes of a shard from the ring"""
+        positions, owners = self._ring
+        self._ring = (
+            tuple(position for position in positions if owners[position] != shard_id),
+            {position: owner for position, owner in owners.items() if owner != shard_id},
+        )
+
+    def get_shard(self, cam_name: str) -> int:
+        """
+        Returns the shard that owns the camera
+
+        Args:
+            cam_name (str): name of the camera
+
+        Returns:
+            int: id of the shard that the camera is assigned to
+        """
+        positions, owners = self._ring
+        if not positions:
+            raise LookupError("The hash ring has no shards")
+        index = bisect.bisect(positions, _hash_key(cam_name)) % len(positions)
+        return owners[positions[index]]
+
+    @property
+    def shard_ids(self):
+        """Returns the ids of all the shards on the ring"""
+        return sorted(set(self._ring[1].values()))
+
+
+class ShardedBuffer:
+    """
+    A class to represent the producer side of the sharded consumers. It exposes the same `put` as the shared buffer,
+    so the cameras keep placing their frames in a single buffer while every frame is routed to the input buffer of
+    the shard that owns its camera. When a camera moves to another shard, its new frames are held back until the shard
+    it leaves has processed the frames it already got, so that a camera is never tracked by two shards at once.
+    """
+
+    def __init__(self, ring: ConsistentHashRing):
+        """Initialize the buffer with the hash ring used for routing"""
+        self.ring = ring
+        self.shard_buffers = {}
+        # frames routed to every shard, and the shared counters of the frames every shard has processed or dropped
+        self.frames_routed = {}
+        self.frames_done = {}
+        # shard every camera is routed to, and the moving cameras mapped to the shard they leave, the frames routed to
+        # that shard before the move and the frames held back since
+        self.camera_shards = {}
+        self.handovers = {}
+        # taken while routing a frame and while changing the shards, so that every move of a camera is seen
+        self.lock = threading.Lock()
+
+    def add_shard_buffer(self, shard_id: int, shard_buffer, frames_done):
+        """Registers the input buffer of a shard and its counter of the frames it is done with"""
+        self.shard_buffers[shard_id] = shard_buffer
+        self.frames_routed[shard_id] = 0
+        self.frames_done[shard_id] = frames_done
+
+    def remove_shard_buffer(self, shard_id: int):
+        """Forgets the input buffer of a stopped shard"""
+        del self.shard_buffers[shard_id]
+        del self.frames_routed[shard_id]
+        del self.frames_done[shard_id]
+
+    def _handover_finished(self, cam_name: str) -> bool:
+        """Returns whether the shard a camera leaves is done with every frame of the camera it got"""
+        previous_shard_id, frames_routed_before, _ = self.handovers[cam_name]
+        # a removed shard has stopped, and the frames it left behind are stale by now since the cameras are live
+        if previous_shard_id not in self.shard_buffers:
+            return True
+        return self.frames_done[previous_shard_id].value >= frames_routed_before
+
+    def _route(self, shard_id: int, camera_elements):
+        """Places the camera elements in the input buffer of a shard"""
+        self.shard_buffers[shard_id].put(camera_elements)
+        self.frames_routed[shard_id] += 1
+
+    def put(self, camera_elements):
+        """Places the camera elements in the input buffer of the shard that owns the camera"""
+        cam_name = camera_elements[1]
+        with self.lock:
+            shard_id = self.ring.get_shard(cam_name)
+            previous_shard_id = self.camera_shards.get(cam_name, shard_id)
+            self.camera_shards[cam_name] = shard_id
+            if previous_shard_id != shard_id and cam_name not in self.handovers:
+                # the buffer of a shard is a queue, so the shard is done with the camera once it is done with as many
+                # frames as it had been given
+                self.handovers[cam_name] = (previous_shard_id, self.frames_routed.get(previous_shard_id, 0), [])
+
+            if cam_name in self.handovers:
+                if not self._handover_finished(cam_name):
+                    self.handovers[cam_name][2].append(camera_elements)
+                    return
+                for held_elements in self.handovers.pop(cam_name)[2]:
+                    self._route(shard_id, held_elements)
+            self._route(shard_id, camera_elements)
+
+    def qsize(self) -> int:
+        """Returns the total number of frames waiting in all the shard buffers"""
+        return sum(shard_buffer.qsize() for shard_buffer in self.shard_buffers.values())
+
+
+class ShardedConsumerPool:
+    """
+    A class to represent a pool of consumer processes with camera affinity. Every camera is assigned to exactly one
+    shard by consistent hashing on its name, so the tracking state of a camera always stays in one worker, and only the
+    cameras owned by an added or removed shard move when the pool is resized. A moving camera is handed over once the
+    shard it leaves is done with its frames.
+    """
+
+    def __init__(self, number_of_shards: int = NUMBER_OF_CONSUMER_SHARDS, load_levels=None, metrics_port=None):
+        """
+        Initialize the pool and start the consumer shards
+
+        Args:
+            number_of_shards (int): number of consumer processes to start with
+            load_levels: shared degradation levels of the cameras. When given, every shard runs a load-shedding
+                controller over the cameras it owns.
+            metrics_port (int): when given, every shard serves its metrics on this port plus its shard id
+        """
+        self.load_levels = load_levels
+        self.metrics_port = metrics_port
+        self.ring = ConsistentHashRing()
+        self.buffer = ShardedBuffer(self.ring)
+        # merged stream of the counts produced by all the shards
+        self.result_buffer = multiprocessing.Queue()
+        self.shards = {}
+        self._next_shard_id = 0
+        for _ in range(number_of_shards):
+            self.add_shard()
+
+    def add_shard(self) -> int:
+        """
+        Starts a new consumer shard and rebalances the cameras onto it
+
+        Returns:
+            int: id of the new shard
+        """
+        shard_id = self._next_shard_id
+        self._next_shard_id += 1
+
+        shard_buffer = multiprocessing.Queue()
+        stop_event = multiprocessing.Event()
+        frames_done = multiprocessing.Value("q", 0)
+        load_controller = None if self.load_levels is None else LoadSheddingController(shared_levels=self.load_levels)
+        metrics_port = None if self.metrics_port is None else self.metrics_port + shard_id
+        process = multiprocessing.Process(
+            target=consumer_main,
+            args=(shard_buffer, self.result_buffer, stop_event, load_controller, metrics_port, frames_done),
+            name=f"consumer-shard-{shard_id}",
+        )
+        process.start()
+
+        self.shards[shard_id] = (process, shard_buffer, stop_event)
+        with self.buffer.lock:
+            self.buffer.add_shard_buffer(shard_id, shard_buffer, frames_done)
+            self.ring.add_shard(shard_id)
+        print(f"Consumer shard {shard_id} started. Active shards: {self.ring.shard_ids}")
+        return shard_id
+
+    def remove_shard(self, shard_id: int):
+        """
+        Stops a consumer shard after its cameras have been rebalanced onto the remaining shards
+
+        Args:
+            shard_id (int): id of the shard to be removed
+        """
+        if len(self.shards) == 1:
+            raise ValueError("Cannot remove the last consumer shard")
+
+        process, shard_buffer, stop_event = self.shards.pop(shard_id)
+        # hold the new frames of its cameras back for the other shards until the shard has stopped
+        with self.buffer.lock:
+            self.ring.remove_shard(shard_id)
+
+        stop_event.set()
+        process.join(SHARD_STOP_TIMEOUT)
+        if process.is_alive():
+            print(f"Consumer shard {shard_id} did not stop in {SHARD_STOP_TIMEOUT} seconds. Terminating...")
+            process.terminate()
+        with self.buffer.lock:
+            self.buffer.remove_shard_buffer(shard_id)
+        shard_buffer.cancel_join_thread()
+        print(f"Consumer shard {shard_id} stopped. Active shards: {self.ring.shard_ids}")
+
+    def assignments(self, cam_names) -> dict:
+        """Returns the shard that every camera is assigned to"""
+        return {cam_name: self.ring.get_shard(cam_name) for cam_name in cam_names}
+
+    def stop(self):
+        """Stops all the consumer shards"""
+        for _, _, stop_event in self.shards.values():
+            stop_event.set()
+        for shard_id, (process, _, _) in self.shards.items():
+            process.join(SHARD_STOP_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+        self.shards.clear()
+
+
+def sharded_main(number_of_shards: int = NUMBER_OF_CONSUMER_SHARDS):
+    """
+    This function starts the cameras and the sharded consumers, and prints the merged counts of all the shards.
+
+    Parameters:
+        number_of_shards: Number of consumer processes the cameras are spread across
+    """
+    # the shards inherit the handler, and the manager ignores the signal, so that profiling the process group does not
+    # kill any of them
+    install_profiler_signal_handler()
+    manager = SyncManager()
+    manager.start(ignore_profile_signal)
+    load_levels = manager.dict()
+    # the producer serves its metrics on METRICS_PORT and the shards on the ports following it
+    pool = ShardedConsumerPool(number_of_shards, load_levels=load_levels, metrics_port=METRICS_PORT + 1)
+    print(f"Camera assignments: {pool.assignments(IP_CAMS)}")
+    producer_main(pool.buffer, load_levels=load_levels, metrics_port=METRICS_PORT)
+
+    try:
+        while True:
+            batch_of_cam_names, batch_of_counts = pool.result_buffer.get()
+            for cam_name, count in zip(batch_of_cam_names, batch_of_counts):
+                print(f"{cam_name}: {count}")
+    except KeyboardInterrupt:
+        print("EXITING THE PROGRAM...")
+    finally:
+        pool.stop()
+        manager.shutdown()
+
+
+if __name__ == "__main__":
+    sharded_main()
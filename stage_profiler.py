@@ -0,0 +1,172 @@
+import linecache
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+
+PROFILE_DURATION = 30
+PROFILE_SAMPLING_INTERVAL = 0.005
+PROFILE_OUTPUT_DIR = "profiles"
+PROFILE_SIGNAL = signal.SIGUSR1
+
+# Pipeline stages recognized from the source line a thread is executing in the repository. The innermost line of the
+# repository that matches decides the stage, so time spent inside a library is charged to the call that made it.
+STAGE_PATTERNS = (
+    ("stream.read()", "decode"),
+    ("cap.read()", "decode"),
+    ("cv2.resize", "resize"),
+    ("shared_buffer.put(", "enqueue"),
+    ("shared_buffer.get(", "batch"),
+    ("shared_buffer.qsize()", "batch"),
+    ("batched_frame_student_count(", "inference"),
+    ("model.track(", "inference"),
+    ("cv2.rectangle", "draw"),
+    ("cv2.circle", "draw"),
+    ("cv2.putText", "draw"),
+    ("cv2.line", "draw"),
+    ("cv2.imshow", "draw"),
+    ("annotate(", "draw"),
+    ("video_writer.write", "encode"),
+    ("cv2.imencode", "encode"),
+)
+# Local variables holding the camera a frame of the stack is working on
+CAMERA_LOCALS = ("cam_name", "camera_id")
+# Functions working on a batch of frames from several cameras, tagged as camera=batch rather than by the camera a
+# loop of theirs left in their local variables
+BATCH_FUNCTIONS = (("multicam_stream_consumer.py", "student_count"),)
+
+_REPOSITORY_DIR = os.path.dirname(os.path.abspath(__file__))
+_profiler_lock = threading.Lock()
+_profiler_thread = None
+
+
+def _stage_and_camera(frame):
+    """Returns the pipeline stage and the camera of a stack, walking from the innermost frame outwards"""
+    stage = None
+    camera = None
+    while frame is not None and (stage is None or camera is None):
+        code = frame.f_code
+        if code.co_filename.startswith(_REPOSITORY_DIR):
+            if stage is None:
+                source_line = linecache.getline(code.co_filename, frame.f_lineno)
+                for pattern, pattern_stage in STAGE_PATTERNS:
+                    if pattern in source_line:
+                        stage = pattern_stage
+                        break
+            if camera is None and (os.path.basename(code.co_filename), code.co_name) in BATCH_FUNCTIONS:
+                camera = "batch"
+            elif camera is None:
+                local_variables = frame.f_locals
+                for name in CAMERA_LOCALS:
+                    if name in local_variables:
+                        camera = local_variables[name]
+                        break
+                else:
+                    owner = local_variables.get("self")
+                    camera = getattr(owner, "cam_name", None)
+        frame = frame.f_back
+    return stage or "other", camera or "none"
+
+
+def _collapse_stack(frame) -> str:
+    """Returns the stack of a frame from the outermost to the innermost function, separated by semicolons"""
+    functions = []
+    while frame is not None:
+        code = frame.f_code
+        functions.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(functions))
+
+
+def _sample(duration: float, interval: float, output_path: str):
+    """Samples the stacks of all the other threads of the process and writes them as collapsed stacks"""
+    global _profiler_thread
+
+    sampler_id = threading.get_ident()
+    process_name = multiprocessing.current_process().name
+    stack_counts = {}
+    end_time = time.monotonic() + duration
+    try:
+        while time.monotonic() < end_time:
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+                stage, camera = _stage_and_camera(frame)
+                thread_name = thread_names.get(thread_id, str(thread_id))
+                stack = f"{process_name};{thread_name};stage={stage};camera={camera};{_collapse_stack(frame)}"
+                stack_counts[stack] = stack_counts.get(stack, 0) + 1
+            time.sleep(interval)
+
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        with open(output_path, "w") as output_file:
+            for stack, count in sorted(stack_counts.items()):
+                output_file.write(f"{stack} {count}\n")
+        print(f"Profile of {process_name} (pid: {os.getpid()}) written to {output_path}")
+    finally:
+        with _profiler_lock:
+            _profiler_thread = None
+
+
+def start_profiling(duration: float = PROFILE_DURATION, interval: float = PROFILE_SAMPLING_INTERVAL,
+                    output_dir: str = PROFILE_OUTPUT_DIR):
+    """
+    Starts sampling the stacks of the process in a background thread. Nothing is sampled, and the hot paths pay
+    nothing, until this is called.
+
+    Args:
+        duration (float): number of seconds to sample for
+        interval (float): number of seconds between two samples
+        output_dir (str): directory the collapsed stacks are written to, one file per process
+
+    Returns:
+        str: path of the file the profile will be written to, or None if the process is already being profiled
+    """
+    global _profiler_thread
+
+    with _profiler_lock:
+        if _profiler_thread is not None:
+            print(f"Process {os.getpid()} is already being profiled")
+            return None
+        output_path = os.path.join(
+            output_dir, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.collapsed"
+        )
+        _profiler_thread = threading.Thread(
+            target=_sample, args=(duration, interval, output_path), name="stage-profiler", daemon=True
+        )
+        _profiler_thread.start()
+    print(f"Profiling process {os.getpid()} for {duration} seconds...")
+    return output_path
+
+
+def _handle_profile_signal(signum, frame):
+    """Starts profiling when the profile signal is received"""
+    start_profiling()
+
+
+def install_profiler_signal_handler(signum=PROFILE_SIGNAL):
+    """
+    Starts profiling the process whenever it receives the signal. Sending the signal to the process group, e.g.
+    `kill -USR1 -<pgid>`, profiles the producer threads and every consumer or camera process at once. The default
+    action of the signal terminates a process, so the entry points install the handler before starting any child
+    process, which inherits it, and the processes that are not profiled ignore the signal.
+
+    Args:
+        signum: signal that starts the profiling
+    """
+    # signal handlers can only be installed from the main thread
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signum, _handle_profile_signal)
+
+
+def ignore_profile_signal(signum=PROFILE_SIGNAL):
+    """
+    Ignores the profile signal, for the processes of the group that are not profiled, such as the server process of a
+    multiprocessing manager, which is started with it as its initializer
+
+    Args:
+        signum: signal that starts the profiling
+    """
+    signal.signal(signum, signal.SIG_IGN)
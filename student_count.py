@@ -1,6 +1,34 @@
 import numpy
 from typing import List
 
+from mosaic_batching import MosaicLayout, detect_in_mosaics
 
-def batched_frame_student_count(batch_of_frames: List[numpy.ndarray], batch_of_cam_names: List[str], batch_of_cam_ips: List[str]):
-    pass
\ No newline at end of file
+BATCHING_STACKED = "stacked"
+BATCHING_MOSAIC = "mosaic"
+# "stacked" runs the detector on every frame of a batch, "mosaic" on canvases tiled with several downscaled frames
+BATCHING_MODE = BATCHING_STACKED
+# Six 16:9 frames of 320x180 on a 640x540 canvas, which fits the 640x640 input of the detector
+MOSAIC_LAYOUT = MosaicLayout(rows=3, cols=2, tile_size=(320, 180))
+
+
+def batched_detections(detect, batch_of_frames: List[numpy.ndarray], batching_mode: str = BATCHING_MODE) -> list:
+    """
+    Runs a detector on a batch of frames, either stacked or tiled into mosaics
+
+    Args:
+        detect: function that takes a list of images and returns the detections (x1, y1, x2, y2, confidence, class)
+            of every image
+        batch_of_frames (List[numpy.ndarray]): frames of the batch
+        batching_mode (str): "stacked" or "mosaic"
+
+    Returns:
+        list: the detections of every frame, in frame coordinates
+    """
+    if batching_mode == BATCHING_MOSAIC:
+        return detect_in_mosaics(detect, batch_of_frames, MOSAIC_LAYOUT)
+    return detect(batch_of_frames)
+
+
+def batched_frame_student_count(batch_of_frames: List[numpy.ndarray], batch_of_cam_names: List[str], batch_of_cam_ips: List[str],
+                                batch_of_capture_times: List[float] = None):
+    pass
@@ -0,0 +1,92 @@
+import queue
+import threading
+import time
+
+import pytest
+
+import multicam_stream_consumer
+
+BATCHES = 1000
+REPEATS = 5
+# Seconds a run of the consumer may take before the test fails instead of hanging
+RUN_TIMEOUT = 60
+# Highest cost in seconds the metrics may add to a batch of BATCH_SIZE frames
+MAX_OVERHEAD_PER_BATCH = 100e-6
+CONSUMER_METRICS = (
+    "QUEUE_DEPTH",
+    "BATCH_ACCUMULATION_SECONDS",
+    "BATCH_FILL_RATIO",
+    "INFERENCE_SECONDS",
+    "CAPTURE_LATENCY_SECONDS",
+    "FRAMES_PROCESSED",
+    "FRAMES_DROPPED",
+    "FRAME_SEQUENCE_GAPS",
+)
+
+
+class NullMetric:
+    """A class to represent a metric that records nothing"""
+
+    def labels(self, *labelvalues):
+        return self
+
+    def inc(self, amount=1):
+        pass
+
+    def set(self, value):
+        pass
+
+    def observe(self, value):
+        pass
+
+
+def _seconds_per_batch() -> float:
+    """Runs the consumer loop over BATCHES batches with a detector that does nothing and returns the time per batch"""
+    shared_buffer = queue.Queue()
+    # frames captured in the future are never stale, however slow the test machine is
+    capture_time = time.monotonic() + 3600
+    for sequence_number in range(BATCHES * multicam_stream_consumer.BATCH_SIZE):
+        shared_buffer.put((None, f"cam-{sequence_number % 4}", "ip", capture_time, sequence_number // 4 + 1))
+
+    stop_event = threading.Event()
+    batches_done = [0]
+
+    def detector(batch_of_frames, batch_of_cam_names, batch_of_cam_ips, batch_of_capture_times=None):
+        batches_done[0] += 1
+        if batches_done[0] == BATCHES:
+            stop_event.set()
+
+    multicam_stream_consumer.batched_frame_student_count = detector
+    consumer = threading.Thread(target=multicam_stream_consumer.student_count, args=(shared_buffer,),
+                                kwargs={"stop_event": stop_event}, daemon=True)
+    start_time = time.perf_counter()
+    consumer.start()
+    consumer.join(RUN_TIMEOUT)
+    elapsed_time = time.perf_counter() - start_time
+    stop_event.set()
+    assert not consumer.is_alive(), f"The consumer processed {batches_done[0]} of {BATCHES} batches"
+    return elapsed_time / BATCHES
+
+
+@pytest.fixture
+def consumer(monkeypatch):
+    """Restores the consumer after the test, and keeps it from purging the preloaded frames"""
+    monkeypatch.setattr(multicam_stream_consumer, "batched_frame_student_count", None)
+    monkeypatch.setattr(multicam_stream_consumer, "last_sequence_numbers", {})
+    monkeypatch.setattr(
+        multicam_stream_consumer, "LIVE_STREAM_BUFFER_SIZE", BATCHES * multicam_stream_consumer.BATCH_SIZE
+    )
+    return monkeypatch
+
+
+def test_metrics_overhead_per_batch(consumer):
+    with_metrics = min(_seconds_per_batch() for _ in range(REPEATS))
+
+    for name in CONSUMER_METRICS:
+        consumer.setattr(multicam_stream_consumer, name, NullMetric())
+    without_metrics = min(_seconds_per_batch() for _ in range(REPEATS))
+
+    overhead = with_metrics - without_metrics
+    print(f"{with_metrics * 1e6:.1f} us per batch with metrics, {without_metrics * 1e6:.1f} us without, "
+          f"{overhead * 1e6:.1f} us overhead")
+    assert overhead < MAX_OVERHEAD_PER_BATCH
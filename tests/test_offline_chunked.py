@@ -0,0 +1,174 @@
+import os
+import time
+
+import cv2
+import numpy
+import pytest
+
+import count_in_line
+import offline_chunked
+
+VIDEO_FPS = 20
+VIDEO_FRAMES = 240
+WORKERS = 4
+LINE_COORDINATES = [(320, 0), (320, 359)]
+# Lane, direction and frame at which every synthetic person crosses the line. The crossings are close to the chunk
+# boundaries at frames 60, 120 and 180, inside the overlaps, and on frames that are not processed, so that no center
+# falls on the line.
+PEOPLE = (
+    (40, 1, 59),
+    (100, -1, 121),
+    (160, 1, 183),
+    (220, -1, 31),
+    (280, 1, 151),
+)
+PERSON_SPEED = 6
+PERSON_SIZE = 30
+# Largest distance in pixels a tracked object moves between two processed frames
+TRACKING_DISTANCE = 40
+
+
+class StubBoxes:
+    """A class to represent the tracked boxes of a frame like the results of ultralytics"""
+
+    def __init__(self, boxes: list):
+        self.boxes = boxes
+
+    def __iter__(self):
+        return iter(self.boxes)
+
+    def __len__(self):
+        return len(self.boxes)
+
+
+class StubBox:
+    """A class to represent a tracked box like the results of ultralytics"""
+
+    def __init__(self, track_id: int, xyxy: tuple):
+        self.id = numpy.array([track_id])
+        self.xyxy = numpy.array([xyxy], dtype=numpy.float32)
+        self.conf = numpy.array([0.9])
+
+
+class StubResult:
+    """A class to represent the result of a tracked frame like ultralytics"""
+
+    def __init__(self, boxes: list):
+        self.boxes = StubBoxes(boxes)
+
+
+class StubTracker:
+    """A class to represent a detector and tracker of the white squares of the synthetic video"""
+
+    def __init__(self):
+        self.tracks = {}
+        self.next_track_id = 1
+
+    def track(self, image, **kwargs):
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        count, _, stats, centers = cv2.connectedComponentsWithStats((gray > 128).astype(numpy.uint8))
+        tracks = {}
+        boxes = []
+        for component in range(1, count):
+            x, y, width, height, area = stats[component]
+            if area < PERSON_SIZE:
+                continue
+            center = centers[component]
+            track_id = next(
+                (
+                    track_id for track_id, position in self.tracks.items()
+                    if track_id not in tracks and numpy.hypot(*(center - position)) < TRACKING_DISTANCE
+                ),
+                None,
+            )
+            if track_id is None:
+                track_id = self.next_track_id
+                self.next_track_id += 1
+            tracks[track_id] = center
+            boxes.append(StubBox(track_id, (x, y, x + width, y + height)))
+        self.tracks = tracks
+        return [StubResult(boxes)]
+
+
+class UnknownLengthCapture:
+    """A class to represent a stream that does not report its number of frames"""
+
+    def __init__(self, source):
+        pass
+
+    def isOpened(self):
+        return True
+
+    def get(self, prop_id):
+        return VIDEO_FPS if prop_id == cv2.CAP_PROP_FPS else 0
+
+    def release(self):
+        pass
+
+
+@pytest.fixture
+def synthetic_video(tmp_path, monkeypatch):
+    """Writes the synthetic video and replaces the detector with the stub tracker"""
+    monkeypatch.setattr(count_in_line, "load_model", lambda model_backend: StubTracker())
+    monkeypatch.setattr(offline_chunked, "load_model", lambda model_backend: StubTracker())
+
+    video_path = str(tmp_path / "door.mp4")
+    width, height = count_in_line.PROCESS_RESOLUTION
+    video_writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"mp4v"), VIDEO_FPS, (width, height))
+    for frame_index in range(VIDEO_FRAMES):
+        frame = numpy.zeros((height, width, 3), dtype=numpy.uint8)
+        for lane, direction, crossing_frame in PEOPLE:
+            x = LINE_COORDINATES[0][0] + direction * PERSON_SPEED * (frame_index - crossing_frame)
+            if PERSON_SIZE <= x < width - PERSON_SIZE:
+                cv2.rectangle(frame, (x - PERSON_SIZE // 2, lane), (x + PERSON_SIZE // 2, lane + PERSON_SIZE),
+                              (255, 255, 255), -1)
+        video_writer.write(frame)
+    video_writer.release()
+    return video_path
+
+
+def test_chunked_counts_match_sequential(synthetic_video):
+    start_time = time.monotonic()
+    chunked_counts = offline_chunked.process_video_chunked(synthetic_video, LINE_COORDINATES, workers=WORKERS)
+    chunked_seconds = time.monotonic() - start_time
+
+    start_time = time.monotonic()
+    sequential_counts = count_in_line.process_camera(
+        "door", synthetic_video, None, LINE_COORDINATES, record_mode="off"
+    )
+    sequential_seconds = time.monotonic() - start_time
+
+    speedup = sequential_seconds / chunked_seconds
+    print(f"Chunked {chunked_seconds:.2f} s with {WORKERS} workers, sequential {sequential_seconds:.2f} s, speedup "
+          f"{speedup:.2f}x on {os.cpu_count()} cores")
+    assert len(chunked_counts["events"]) == len(PEOPLE)
+    assert {key: chunked_counts[key] for key in ("IN", "OUT", "INSIDE")} == sequential_counts
+
+
+def test_stitched_timeline_matches_one_chunk(synthetic_video):
+    frame_count = VIDEO_FRAMES
+    whole_video = offline_chunked.process_chunk(synthetic_video, 0, frame_count)
+    sequential = offline_chunked.count_timeline(sorted(whole_video.items()), LINE_COORDINATES)
+
+    chunk_length = frame_count // WORKERS
+    overlap_frames = int(offline_chunked.CHUNK_OVERLAP_SECONDS * VIDEO_FPS)
+    chunk_ranges = [
+        (max(0, own_start - overlap_frames), own_start, own_start + chunk_length)
+        for own_start in range(0, frame_count, chunk_length)
+    ]
+    chunk_observations = [
+        offline_chunked.process_chunk(synthetic_video, overlap_start, end) for overlap_start, _, end in chunk_ranges
+    ]
+    stitched = offline_chunked.count_timeline(
+        offline_chunked.stitch_chunks(chunk_ranges, chunk_observations), LINE_COORDINATES
+    )
+
+    assert [(frame, direction) for frame, _, direction in stitched["events"]] == \
+        [(frame, direction) for frame, _, direction in sequential["events"]]
+    assert stitched["IN"] == sequential["IN"] and stitched["OUT"] == sequential["OUT"]
+
+
+def test_unknown_frame_count_is_rejected(synthetic_video, monkeypatch):
+    monkeypatch.setattr(offline_chunked.cv2, "VideoCapture", UnknownLengthCapture)
+    with pytest.raises(ValueError, match="number of frames"):
+        offline_chunked.process_video_chunked(synthetic_video, LINE_COORDINATES, workers=WORKERS)